@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
-import sys, time, traceback
+import sys, os, time, traceback, shutil, tempfile, heapq, hashlib, collections
+import calendar, array, bisect, json
+import threading, Queue
 import seiscomp3.Client, seiscomp3.DataModel
 import re, math
+import msrecord
 
 max_station_distance_km = 300 
 stream_whitelist = ["HH", "EH", "SH", "HG", "HN", "EN", "EG","SN"]
@@ -14,10 +17,199 @@ network_whitelist = []  # all except blacklist
 before, after = 60, 120
 regex = re.compile('/')
 sort = True  # will produce sorted files with ".sorted-mseed" extension
+# maximum number of concurrent requests per RecordStream URL
+max_requests = 4
+# --start/--end windows are requested in chunks of this many seconds
+chunk_length = 3600
+# records to sort are kept in memory up to this many bytes, the rest is
+# sorted in runs on disk
+sort_memory = 512 * 1024 * 1024
+# the station table loaded from the inventory is kept on disk for this long
+inventory_max_age = 86400
+inventory_cache = os.path.expanduser("~/.cache/sc3-playback")
+# number of records remembered to find duplicates in unsorted output
+max_digests = 200000
+# number of finished requests waiting to be merged into the output
+max_pending_requests = 16
+# data older than this many seconds is assumed to be complete in the
+# archives, so the waveform cache remembers when there was none
+cache_settle_time = 3600
+number_of_attempts = 1  # increase in case of connection problems, normally not needed
+
+def split_window(t1, t2, length):
+    """
+    Split the time window from *t1* to *t2* into windows of at most
+    *length* seconds.
+    """
+    windows = []
+    start = t1
+    while start < t2:
+        end = start + seiscomp3.Core.TimeSpan(length)
+        if end > t2:
+            end = t2
+        windows.append((start, end))
+        start = end
+    return windows
+
+def epoch(t):
+    """
+    Convert a seiscomp3.Core.Time to seconds since 1970.
+    """
+    return t.seconds() + t.microseconds() * 1e-6
+
+def to_time(seconds):
+    """
+    Convert seconds since 1970 to a seiscomp3.Core.Time.
+    """
+    usec = int(round(seconds * 1e6))
+    return seiscomp3.Core.Time(usec // 1000000, usec % 1000000)
+
+def merge_ranges(ranges):
+    """
+    Merge overlapping (start, end) time ranges.
+    """
+    merged = []
+    for r1, r2 in sorted(ranges):
+        if merged and r1 <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], r2))
+        else:
+            merged.append((r1, r2))
+    return merged
+
+def merge_sources(results):
+    """
+    Merge the records returned by several sources for the same request.
+
+    *results* holds a list of (endTime, raw) tuples per source, highest
+    priority first, or None if the source failed. Per stream, records of
+    a source are only used if they are not entirely within the time
+    covered by the sources before it, i.e. lower priority sources only
+    fill gaps.
+    """
+    covered = {}
+    merged = []
+    for records in results:
+        if not records:
+            continue
+        added = {}
+        for endTime, raw in records:
+            rec = msrecord.Record(raw)
+            stream = (rec.net, rec.sta, rec.loc, rec.cha)
+            # adjacent records are continuous within half a sample
+            tolerance = 0.5 / rec.fsamp if rec.fsamp else 0.
+            begin, end = rec.begin - tolerance, rec.end + tolerance
+            if any(r1 <= begin and end <= r2 for r1, r2 in covered.get(stream, ())):
+                continue
+            merged.append((endTime, raw))
+            added.setdefault(stream, []).append((begin, end))
+        for stream, ranges in added.iteritems():
+            covered[stream] = merge_ranges(covered.get(stream, []) + ranges)
+    return merged
+
+def read_records(filename):
+    """
+    Return the end time and raw data of all records in a MiniSEED file.
+    """
+    f = open(filename, 'rb')
+    try:
+        return [(rec.end, str(rec.raw())) for rec in msrecord.read_records(f)]
+    finally:
+        f.close()
+
+def parse_request_limits(value):
+    """
+    Parse a limit for the number of concurrent requests, either a number
+    for all RecordStream URLs or a comma separated list of 'URL=number'.
+    The limit for all URLs not listed is stored with the key None.
+    """
+    limits = {None: max_requests}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        url, sep, n = item.rpartition('=')
+        if not sep:
+            url = None
+        limits[url] = int(n)
+        if limits[url] < 1:
+            raise ValueError("invalid request limit '%s'" % item)
+    return limits
+
+
+class RequestPool(object):
+    """
+    Run requests on a bounded number of worker threads.
+
+    At most *limits[url]* (or *limits[None]*) requests to the same
+    RecordStream URL run at the same time. Every URL has its own queue and
+    threads, so a slow source does not hold up the requests to the others.
+    Exceptions raised by a request are printed and counted in *failed*.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.queues = {}
+        self.njobs = {}
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(self.njobs.itervalues())
+
+    def limit(self, url):
+        return self.limits.get(url, self.limits[None])
+
+    def add(self, url, func, *args):
+        if url not in self.queues:
+            self.queues[url] = Queue.Queue()
+            self.njobs[url] = 0
+        self.njobs[url] += 1
+        self.queues[url].put((func, args))
+
+    def _worker(self, queue):
+        while True:
+            try:
+                func, args = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                func(*args)
+            except:
+                info = traceback.format_exception(*sys.exc_info())
+                with self.lock:
+                    self.failed += 1
+                    for i in info: sys.stderr.write(i)
+
+    def start(self):
+        """
+        Start running the requests that have been added.
+        """
+        self.threads = [threading.Thread(target=self._worker,
+                                         args=(self.queues[url],))
+                        for url, n in self.njobs.iteritems()
+                        for i in xrange(min(self.limit(url), n))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def join(self):
+        """
+        Wait for all requests.
+        """
+        # join with a timeout to stay responsive to KeyboardInterrupt
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1)
+
+    def run(self):
+        """
+        Run all requests that have been added and wait for them.
+        """
+        self.start()
+        self.join()
 
 def haversine(lon1, lat1, lon2, lat2):
     # convert decimal degrees to radians
-    print([lon1, lat1, lon2, lat2])
     lon1, lat1, lon2, lat2 = map(math.radians, [lon1, lat1, lon2, lat2])
 
     # haversine formula
@@ -34,67 +226,542 @@ def filterStreams(streams):
     # contexts HH would have priority over BH
 
     filtered = []
+    available = set(streams)
 
     for net, sta, loc, cha in streams:
-        if cha[:2] in [ "HH", "SH" ] and (net, sta, loc, "BH" + cha[-1]) in streams:
+        if cha[:2] in [ "HH", "SH" ] and (net, sta, loc, "BH" + cha[-1]) in available:
             continue
         filtered.append((net, sta, loc, cha))
 
     return filtered
 
 
-def getCurrentStreams(dbr, now=None, org=None, radius=max_station_distance_km):
+class StationTable(object):
+    """
+    Coordinates, epochs and streams of all stations of an inventory in
+    flat columns sorted by latitude.
+
+    Stations within a radius are found by bisecting the latitude column
+    for the band that can be within the radius and computing distances
+    only for the stations in it. The table can be saved to and loaded from
+    a JSON file so the inventory does not have to be read from the
+    database every time. Stations without an end time have end = inf.
+    """
+
+    version = 1
+    km_per_degree = 6371 * math.pi / 180
+
+    def __init__(self):
+        self.created = time.time()
+        self.net = []
+        self.sta = []
+        self.lat = array.array('d')
+        self.lon = array.array('d')
+        self.start = array.array('d')
+        self.end = array.array('d')
+        self.streams = []
+
+    def __len__(self):
+        return len(self.sta)
+
+    def _fill(self, rows):
+        rows.sort()
+        for lat, lon, net, sta, start, end, streams in rows:
+            self.lat.append(lat)
+            self.lon.append(lon)
+            # codes loaded from JSON are unicode
+            self.net.append(str(net))
+            self.sta.append(str(sta))
+            self.start.append(start)
+            self.end.append(end)
+            self.streams.append([(str(loc), str(cha)) for loc, cha in streams])
+
+    @classmethod
+    def from_inventory(cls, dbr):
+        """
+        Read the stations of all networks from the DatabaseReader *dbr*.
+        """
+        table = cls()
+        inv = seiscomp3.DataModel.Inventory()
+        dbr.loadNetworks(inv)
+        rows = []
+        for inet in xrange(inv.networkCount()):
+            network = inv.network(inet)
+            dbr.load(network);
+            for ista in xrange(network.stationCount()):
+                station = network.station(ista)
+                try:
+                    start = epoch(station.start())
+                except:
+                    continue
+                try:
+                    end = epoch(station.end())
+                except:
+                    end = float('inf')
+                streams = []
+                for iloc in xrange(station.sensorLocationCount()):
+                    loc = station.sensorLocation(iloc)
+                    for istr in xrange(loc.streamCount()):
+                        streams.append((loc.code(), loc.stream(istr).code()))
+                rows.append((station.latitude(), station.longitude(), network.code(), station.code(), start, end, streams))
+        table._fill(rows)
+        return table
+
+    @classmethod
+    def load(cls, filename, max_age=inventory_max_age):
+        """
+        Load a table saved with save(), or return None if the file does
+        not exist or is older than *max_age* seconds.
+        """
+        try:
+            f = open(filename)
+            try:
+                content = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+        if content.get("version") != cls.version or time.time() - content["created"] > max_age:
+            return None
+        table = cls()
+        table.created = content["created"]
+        table._fill([tuple(row) for row in content["stations"]])
+        return table
+
+    def save(self, filename):
+        rows = zip(self.lat, self.lon, self.net, self.sta, self.start, self.end, self.streams)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        tmp = "%s.%d.tmp" % (filename, os.getpid())
+        f = open(tmp, "w")
+        try:
+            json.dump({"version": self.version, "created": self.created, "stations": rows}, f)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+    def within(self, lat, lon, radius):
+        """
+        Return the indices of the stations within *radius* km of the
+        given coordinates.
+        """
+        dlat = radius / self.km_per_degree
+        lo = bisect.bisect_left(self.lat, lat - dlat)
+        hi = bisect.bisect_right(self.lat, lat + dlat)
+        return [i for i in xrange(lo, hi)
+                if haversine(self.lon[i], self.lat[i], lon, lat) <= radius]
+
+
+def getCurrentStreams(table, now=None, org=None, radius=max_station_distance_km):
     if now is None:
         now = seiscomp3.Core.Time.GMT()
-    inv = seiscomp3.DataModel.Inventory()
-    dbr.loadNetworks(inv)
+    now = epoch(now)
+
+    if org is not None:
+        stations = table.within(org.latitude().value(), org.longitude().value(), radius)
+    else:
+        stations = xrange(len(table))
 
     result = []
 
-    for inet in xrange(inv.networkCount()):
-        network = inv.network(inet)
-        if network_blacklist and network.code()     in network_blacklist:
+    for i in stations:
+        net = table.net[i]
+        if network_blacklist and net     in network_blacklist:
             continue
-        if network_whitelist and network.code() not in network_whitelist:
+        if network_whitelist and net not in network_whitelist:
             continue
-        dbr.load(network);
-        for ista in xrange(network.stationCount()):
-            station = network.station(ista)
-            try:
-                start = station.start()
-            except:
+        if not table.start[i] <= now <= table.end[i]:
+            continue
+
+        # now we know that this is an operational station
+
+        for loc, cha in table.streams[i]:
+            if cha[:2] not in stream_whitelist:
                 continue
+            result.append((net, table.sta[i], loc, cha))
+
+    return filterStreams(result)
+
+
+class RecordSorter(object):
+    """
+    Sort records by end time within a memory budget.
+
+    Records are collected in memory until their size exceeds *budget*
+    bytes. Then they are sorted and written to a temporary file in *dir*
+    (a run), and at the end all runs are merged. Not thread safe.
+    """
+
+    def __init__(self, budget=sort_memory, dir=None):
+        self.budget = budget
+        self.dir = dir
+        self.tmpdir = None
+        self.runs = []
+        self.records = []
+        self.size = 0
+
+    def add(self, endTime, raw):
+        self.records.append((endTime, raw))
+        self.size += len(raw)
+        if self.size > self.budget:
+            self._spill()
+
+    def _spill(self):
+        if self.tmpdir is None:
+            self.tmpdir = tempfile.mkdtemp(prefix='sort-', dir=self.dir)
+        self.records.sort()
+        filename = os.path.join(self.tmpdir, 'run%04d.mseed' % len(self.runs))
+        f = open(filename, 'wb')
+        try:
+            for endTime, raw in self.records:
+                f.write(raw)
+        finally:
+            f.close()
+        self.runs.append(msrecord.MSeedFile(filename))
+        self.records = []
+        self.size = 0
+
+    def __iter__(self):
+        """
+        Iterate over the end time and raw data of all records in end time
+        order.
+        """
+        if not self.runs:
+            self.records.sort()
+            return iter(self.records)
+        if self.records:
+            self._spill()
+        sys.stderr.write("Merging %d sorted runs\n" % len(self.runs))
+        # merge in the same (endTime, raw) order as the in-memory sort
+        return heapq.merge(*[((rec.end, str(rec.raw())) for rec in run)
+                             for run in self.runs])
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.records = []
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir)
+            self.tmpdir = None
+
 
+class SourceMerger(object):
+    """
+    Combine the answers of several sources to the same request.
+
+    Every source is requested with request(), passing its records to the
+    collector() of its position in the priority list. When all sources
+    have passed their records on, they are merged with merge_sources() and
+    passed to *collect*. If a source failed or was interrupted nothing is
+    passed on, so an incomplete result is never checkpointed. *done* is
+    always called.
+    """
+
+    def __init__(self, nsources, collect, done):
+        self.results = [None] * nsources
+        self.remaining = nsources
+        self.collect = collect
+        self.done = done
+        self.lock = threading.Lock()
+
+    def collector(self, i):
+        def collect(records):
+            self.results[i] = records
+        return collect
+
+    def request(self, func, *args):
+        try:
+            func(*args)
+        finally:
+            with self.lock:
+                self.remaining -= 1
+                last = self.remaining == 0
+            if last:
+                try:
+                    if all(r is not None for r in self.results):
+                        self.collect(merge_sources(self.results))
+                finally:
+                    self.done()
+
+
+class SortedOutput(object):
+    """
+    Write records in end time order while other requests are still
+    running.
+
+    Every request is registered with the start of its time window before
+    it runs and its records are added when it is complete. No record still
+    to come can end before the earliest window start of the requests that
+    are not done (the watermark), so all records ending before it are
+    written at once; the others wait in a heap. If more than *budget*
+    bytes are waiting, the waiting records and all records added later are
+    sorted with a RecordSorter and only written by close(). Duplicates
+    are dropped with *dedup*.
+    """
+
+    def __init__(self, out, dedup, budget=sort_memory, dir=None):
+        self.out = out
+        self.dedup = dedup
+        self.budget = budget
+        self.dir = dir
+        self.pending = {}
+        self.heap = []
+        self.size = 0
+        self.sorter = None
+
+    def register(self, request, start):
+        self.pending[request] = start
+
+    def add(self, records):
+        if self.sorter is not None:
+            for endTime, raw in records:
+                self.sorter.add(endTime, raw)
+            return
+        for endTime, raw in records:
+            heapq.heappush(self.heap, (endTime, raw))
+            self.size += len(raw)
+        if self.size > self.budget:
+            sys.stderr.write("More than %d MB waiting to be written, sorting the rest on disk\n" % (self.budget >> 20))
+            self.sorter = RecordSorter(self.budget, self.dir)
+            for endTime, raw in self.heap:
+                self.sorter.add(endTime, raw)
+            self.heap = []
+            self.size = 0
+
+    def done(self, request):
+        del self.pending[request]
+        self.flush()
+
+    def flush(self):
+        if self.sorter is not None:
+            return
+        watermark = min(self.pending.itervalues()) if self.pending else float('inf')
+        while self.heap and self.heap[0][0] < watermark:
+            endTime, raw = heapq.heappop(self.heap)
+            self.size -= len(raw)
+            self._write(endTime, raw)
+
+    def _write(self, endTime, raw):
+        if self.dedup.seen(endTime, raw):
+            # unfortunately duplicates do happen sometimes
+            return
+        self.out.write("%s" % raw)
+
+    def close(self):
+        """
+        Write all remaining records.
+        """
+        self.pending.clear()
+        self.flush()
+        if self.sorter is not None:
             try:
-                end = station.end()
-                if not start <= now <= end:
-                    continue
-            except:
-                pass
-
-            if org is not None:
-                haversine_inputs=[station.longitude(),
-                                  station.latitude(),
-                                  org.longitude().value(),
-                                  org.latitude().value()]
-                ep_dist = haversine(*haversine_inputs)
-                if ep_dist > radius:
-                    print('skip %s.%s (%s > %s)'%(network.code(), station.code(), ep_dist, radius))
-                    continue
+                for endTime, raw in self.sorter:
+                    self._write(endTime, raw)
+            finally:
+                self.sorter.close()
+                self.sorter = None
+
+
+class WaveformCache(object):
+    """
+    Local copy of the records fetched from a RecordStream.
 
-            # now we know that this is an operational station
+    The records are stored in an SDS tree under *root*. For every stream
+    the time ranges that are cached are listed in
+    'coverage/NET.STA.LOC.CHA' (one 'start end' line in seconds since 1970
+    per range). A request covers its whole time window for every
+    stream, with or without data, as far as the window is older than
+    *settle* seconds. More recent data may not have reached the archive
+    yet, so there only the part the server returned records for is
+    covered and the rest is requested again. A record is only stored if
+    it does not overlap a range that was already covered, as it would
+    have been returned by the earlier request as well. The cache may be
+    used by several threads but not by several processes at the same
+    time.
+    """
 
-            for iloc in xrange(station.sensorLocationCount()):
-                loc = station.sensorLocation(iloc)
+    def __init__(self, root, settle=cache_settle_time):
+        self.root = root
+        self.settle = settle
+        self.coverage = {}
+        self.lock = threading.Lock()
+        self.requests = self.hits = 0
 
-                for istr in xrange(loc.streamCount()):
-                    stream = loc.stream(istr)
-                    if stream.code()[:2] not in stream_whitelist:
+    def _coverage_file(self, stream):
+        return os.path.join(self.root, 'coverage', '.'.join(stream))
+
+    def _ranges(self, stream):
+        ranges = self.coverage.get(stream)
+        if ranges is None:
+            ranges = []
+            filename = self._coverage_file(stream)
+            if os.path.exists(filename):
+                for line in open(filename):
+                    start, end = line.split()
+                    ranges.append((float(start), float(end)))
+            self.coverage[stream] = ranges
+        return ranges
+
+    def _add_range(self, stream, start, end):
+        merged = merge_ranges(self._ranges(stream) + [(start, end)])
+        self.coverage[stream] = merged
+        filename = self._coverage_file(stream)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        tmp = filename + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            for r1, r2 in merged:
+                f.write('%.6f %.6f\n' % (r1, r2))
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+    def _covered(self, stream, start, end):
+        for r1, r2 in self._ranges(stream):
+            if r1 < end and start < r2:
+                return True
+        return False
+
+    def missing(self, streams, start, end):
+        """
+        Return the time ranges between *start* and *end* that are not
+        cached, as a sorted list of ((start, end), streams) tuples with the
+        *streams* missing that range.
+        """
+        with self.lock:
+            gaps = {}
+            for stream in streams:
+                t = start
+                for r1, r2 in self._ranges(stream):
+                    if r2 <= t or r1 >= end:
                         continue
+                    if r1 > t:
+                        gaps.setdefault((t, r1), []).append(stream)
+                    t = max(t, r2)
+                if t < end:
+                    gaps.setdefault((t, end), []).append(stream)
+            self.requests += 1
+            if not gaps:
+                self.hits += 1
+            return sorted(gaps.iteritems())
 
-                    result.append((network.code(), station.code(), loc.code(), stream.code()))
+    def _sds_file(self, stream, t):
+        net, sta, loc, cha = stream
+        tm = time.gmtime(t)
+        return os.path.join(self.root, str(tm.tm_year), net, sta, cha + '.D',
+                            '%s.%s.%s.%s.D.%d.%03d' % (net, sta, loc, cha, tm.tm_year, tm.tm_yday))
 
-    return filterStreams(result)
+    def store(self, streams, records, start, end):
+        """
+        Add the *records* fetched for *streams* between *start* and *end*.
+        For every stream the window is marked as covered up to *settle*
+        seconds before now, and up to its last record within the window.
+        """
+        with self.lock:
+            files = {}
+            extent = {}
+            try:
+                for endTime, raw in records:
+                    rec = msrecord.Record(raw)
+                    stream = (rec.net, rec.sta, rec.loc, rec.cha)
+                    r1, r2 = extent.get(stream, (rec.begin, rec.end))
+                    extent[stream] = (min(r1, rec.begin), max(r2, rec.end))
+                    if self._covered(stream, rec.begin, rec.end):
+                        continue
+                    filename = self._sds_file(stream, rec.begin)
+                    f = files.get(filename)
+                    if f is None:
+                        if not os.path.isdir(os.path.dirname(filename)):
+                            os.makedirs(os.path.dirname(filename))
+                        f = files[filename] = open(filename, 'ab')
+                    f.write(raw)
+            finally:
+                for f in files.itervalues():
+                    f.close()
+            settled = min(end, time.time() - self.settle)
+            for stream in streams:
+                ranges = []
+                if start < settled:
+                    ranges.append((start, settled))
+                if stream in extent:
+                    r1, r2 = extent[stream]
+                    r1, r2 = max(r1, start), min(r2, end)
+                    if r1 < r2:
+                        ranges.append((r1, r2))
+                for r1, r2 in merge_ranges(ranges):
+                    self._add_range(stream, r1, r2)
+
+    def read(self, streams, start, end):
+        """
+        Return the end time and raw data of the cached records of
+        *streams* between *start* and *end*.
+        """
+        records = []
+        # store() may be appending to the same day files
+        with self.lock:
+            for stream in streams:
+                # records starting the day before may reach into the window
+                day = calendar.timegm(time.gmtime(start)[:3] + (0, 0, 0)) - 86400
+                while day < end:
+                    filename = self._sds_file(stream, day)
+                    day += 86400
+                    if not os.path.exists(filename):
+                        continue
+                    wf = msrecord.MSeedFile(filename)
+                    try:
+                        for rec in wf:
+                            if (rec.net, rec.sta, rec.loc, rec.cha) == stream and rec.end > start and rec.begin < end:
+                                records.append((rec.end, str(rec.raw())))
+                    finally:
+                        wf.close()
+        return records
+
+
+class Deduplicator(object):
+    """
+    Find records that have been seen before.
+
+    Records are compared by a digest of everything but the sequence
+    number and quality indicator, i.e. the stream, start time, header
+    fields and payload. Duplicates share the same end time, so for
+    records in end time order (*ordered*) only the digests of records
+    ending at the current time are kept. Otherwise the last *size*
+    digests are remembered. The number of duplicates is counted per
+    stream in *duplicates*.
+    """
+
+    def __init__(self, ordered=True, size=max_digests):
+        self.ordered = ordered
+        self.size = size
+        self.current = None
+        self.digests = set()
+        self.history = collections.deque()
+        self.duplicates = {}
+
+    def seen(self, endTime, raw):
+        if self.ordered and endTime != self.current:
+            self.current = endTime
+            self.digests.clear()
+        digest = hashlib.md5(raw[8:]).digest()
+        if digest in self.digests:
+            sid = msrecord.Record(raw).stream_id()
+            self.duplicates[sid] = self.duplicates.get(sid, 0) + 1
+            return True
+        self.digests.add(digest)
+        if not self.ordered:
+            self.history.append(digest)
+            if len(self.history) > self.size:
+                self.digests.discard(self.history.popleft())
+        return False
+
+    def report(self):
+        if not self.duplicates:
+            return
+        sys.stderr.write("Removed %d duplicate records\n" % sum(self.duplicates.values()))
+        for sid in sorted(self.duplicates):
+            sys.stderr.write("  %s: %d\n" % (sid, self.duplicates[sid]))
 
 
 class DumperApp(seiscomp3.Client.Application):
@@ -122,81 +789,275 @@ class DumperApp(seiscomp3.Client.Application):
         try:
             try:
                 self.commandline().addGroup("Dump")
-                self.commandline().addStringOption("Dump", "event,E", "ID of event to dump")
+                self.commandline().addStringOption("Dump", "event,E", "ID of event to dump, or a comma separated list of IDs")
+                self.commandline().addStringOption("Dump", "events", "file with one event ID per line to dump in one go ('-' for stdin)")
                 self.commandline().addStringOption("Dump", "radius,R", "Maximum event radius within to dump stations")
                 self.commandline().addStringOption("Dump", "start", "Start time")
                 self.commandline().addStringOption("Dump", "end", "End time")
 
                 self.commandline().addOption("Dump", "unsorted,U", "produce unsorted output (not suitable for direct playback!)")
+                self.commandline().addStringOption("Dump", "max-requests", "maximum number of concurrent requests, either one number or 'URL=number,...' per RecordStream URL (default: %d)" % max_requests)
+                self.commandline().addOption("Dump", "per-station", "request every station separately instead of every network")
+                self.commandline().addStringOption("Dump", "chunk", "with --start/--end request the data in chunks of this many seconds and keep finished chunks to resume an interrupted run; 0 requests the whole window at once (default: %d)" % chunk_length)
+                self.commandline().addStringOption("Dump", "sources", "space separated RecordStream URLs to request the data from, highest priority first; streams are merged and lower priority sources only fill gaps (default: the RecordStream given with -I)")
+                self.commandline().addStringOption("Dump", "cache", "directory of a local waveform cache with one SDS tree per RecordStream URL; only data that is not cached yet is requested")
+                self.commandline().addStringOption("Dump", "inventory-cache", "directory to keep the station table of the inventory in for a day; empty to always read the database (default: %s)" % inventory_cache)
+                self.commandline().addOption("Dump", "refresh-inventory", "read the inventory from the database even if it is cached")
+                self.commandline().addStringOption("Dump", "sort-memory", "memory in MB for sorting the records; more data is sorted in temporary files next to the output file (default: %d)" % (sort_memory >> 20))
+                self.commandline().addStringOption("Dump", "attempts", "number of attempts for every request (default: %d, or 3 with --start/--end)" % number_of_attempts)
             except:
                 seiscomp3.Logging.warning("caught unexpected error %s" % sys.exc_info())
         except:
             info = traceback.format_exception(*sys.exc_info())
             for i in info: sys.stderr.write(i)
 
-    def get_and_write_data(self, t1, t2, out, org=None, radius = max_station_distance_km):
-        dbr = seiscomp3.DataModel.DatabaseReader(self.database())
-        streams = getCurrentStreams(dbr, t1, org, radius)
+    def fetch(self, url, streams, t1, t2, collect, attempts=1):
+        """
+        Request *streams* between *t1* and *t2* from the RecordStream *url*
+        and pass the end time and raw data of the records to *collect*.
+
+        The request is repeated up to *attempts* times if it fails, also if
+        reading the records fails after some have been received. If every
+        attempt failed the last error is raised and *collect* is not called.
+        Neither is it if the application is asked to exit.
+        """
+        for attempt in xrange(attempts):
+            if self.isExitRequested(): return
 
-        # split all streams into groups of same net
+            error = None
+            records = []
+            try:
+                stream = seiscomp3.IO.RecordStream.Open(url)
+                if stream is None:
+                    raise IOError("cannot open RecordStream %s" % url)
+                stream.setTimeout(3600)
+                for net, sta, loc, cha in streams:
+                    stream.addStream(net, sta, loc, cha, t1, t2)
+
+                input = seiscomp3.IO.RecordInput(stream, seiscomp3.Core.Array.INT, seiscomp3.Core.Record.SAVE_RAW)
+                while 1:
+                    # stop without passing the incomplete result on
+                    if self.isExitRequested(): return
+                    # read errors are retried like any other failure
+                    rec = input.next()
+                    if not rec:
+                        break
+                    raw = rec.raw().str()
+                    records.append((msrecord.Record(raw).end, raw))
+            except Exception, e:
+                error = e
+                sys.stderr.write("Request for %d streams from %s to %s failed: %s\n" % (len(streams), t1, t2, e))
+
+            if error is None:
+                sys.stderr.write("Read %d records for %d streams\n" % (len(records), len(streams)))
+                collect(records)
+                return
+            if attempt + 1 == attempts:
+                raise error
+            if self.isExitRequested(): return
+            sys.stderr.write("Trying again\n")
+            time.sleep(5)
+
+    def waveformCache(self, url):
+        """
+        Return the WaveformCache for the RecordStream *url*, or None if no
+        cache is used.
+        """
+        if not self.cache_dir:
+            return None
+        cache = self.caches.get(url)
+        if cache is None:
+            # records from different sources are cached separately
+            source = re.sub('[^A-Za-z0-9.-]+', '_', url)
+            cache = self.caches[url] = WaveformCache(os.path.join(self.cache_dir, source))
+        return cache
+
+    def request(self, url, streams, t1, t2, collect):
+        """
+        Fetch *streams* from *url*, through the waveform cache if there is
+        one.
+        """
+        cache = self.waveformCache(url)
+        if cache is not None:
+            self.fetch_cached(cache, url, streams, t1, t2, collect, self.attempts)
+        else:
+            self.fetch(url, streams, t1, t2, collect, self.attempts)
+
+    def fetch_cached(self, cache, url, streams, t1, t2, collect, attempts=1):
+        """
+        Like fetch(), but only request the streams and time ranges that are
+        not yet in the WaveformCache *cache* and pass all records from the
+        cache. If *collect* is None the records are only added to the cache.
+        """
+        start, end = epoch(t1), epoch(t2)
+        for (gap1, gap2), gstreams in cache.missing(streams, start, end):
+            def store(records, gap1=gap1, gap2=gap2, gstreams=gstreams):
+                cache.store(gstreams, records, gap1, gap2)
+            self.fetch(url, gstreams, to_time(gap1), to_time(gap2), store, attempts)
+            if self.isExitRequested(): return
+        if collect is not None:
+            collect(cache.read(streams, start, end))
+
+    def stationTable(self):
+        """
+        Return the StationTable of the inventory in the database, loading
+        it only once and from the inventory cache if possible.
+        """
+        if self.stations is not None:
+            return self.stations
+        filename = None
+        if self.inventory_cache:
+            key = hashlib.md5(self.databaseURI()).hexdigest()[:16]
+            filename = os.path.join(self.inventory_cache, "inventory-%s.json" % key)
+            if not self.commandline().hasOption("refresh-inventory"):
+                self.stations = StationTable.load(filename)
+        if self.stations is None:
+            dbr = seiscomp3.DataModel.DatabaseReader(self.database())
+            self.stations = StationTable.from_inventory(dbr)
+            if filename:
+                try:
+                    self.stations.save(filename)
+                except (IOError, OSError), e:
+                    sys.stderr.write("Cannot save the inventory to %s: %s\n" % (filename, e))
+        return self.stations
+
+    def get_and_write_data(self, t1, t2, out, org=None, radius = max_station_distance_km, chunk=None, checkpoint_dir=None):
+        """
+        Write the records of all current streams between *t1* and *t2* to
+        *out*.
+
+        If *chunk* is given the time window is requested in chunks of that
+        many seconds, each fetched and retried on its own. With
+        *checkpoint_dir* every chunk is saved there once it is complete,
+        and chunks that already exist are read back instead of being
+        requested again. The directory is removed when *out* is complete.
+        If a waveform cache is used only the data that is not cached yet is
+        requested, and no checkpoints are needed. With several sources all
+        of them are requested and merged by priority with merge_sources().
+        Return False, with *out* incomplete, if any request failed or the
+        application is asked to exit.
+        """
+        streams = getCurrentStreams(self.stationTable(), t1, org, radius)
+
+        # split all streams into groups of same net (or station)
         netsta_streams = {}
         for net, sta, loc, cha in streams:
+            if component_whitelist and cha[-1] not in component_whitelist:
+                continue
             netsta = net
+            if self.per_station:
+                netsta = (net, sta)
             if not netsta in netsta_streams:
                 netsta_streams[netsta] = []
             netsta_streams[netsta].append((net, sta, loc, cha))
         print(netsta_streams)
-        data = []
-        netsta_keys = netsta_streams.keys()
-        netsta_keys.sort()
-        for netsta in netsta_keys:
+        dedup = Deduplicator(ordered=sort)
+        output = SortedOutput(out, dedup, self.sort_memory, os.path.dirname(os.path.abspath(out.name)))
+        # finished requests pass their records to the main thread, which
+        # merges them into the output
+        finished = Queue.Queue(max_pending_requests)
+        lock = threading.Lock()
 
-            number_of_attempts = 1  # experts only: increase in case of connection problems, normally not needed
-            for attempt in xrange(number_of_attempts):
-                if self.isExitRequested(): return
+        def collect(records):
+            if sort:
+                finished.put(("records", records))
+            else:
+                with lock:
+                    for endTime, raw in records:
+                        if not dedup.seen(endTime, raw):
+                            out.write("%s" % raw)
 
-                stream = seiscomp3.IO.RecordStream.Open(self.recordStreamURL())
-                stream.setTimeout(3600)
-                for net, sta, loc, cha in netsta_streams[netsta]:
-                    if component_whitelist and cha[-1] not in component_whitelist:
-                        continue
-                    stream.addStream(net, sta, loc, cha, t1, t2)
+        def checkpoint(filename):
+            def save(records):
+                tmp = filename + '.tmp'
+                f = open(tmp, 'wb')
+                try:
+                    for endTime, raw in records:
+                        f.write(raw)
+                finally:
+                    f.close()
+                os.rename(tmp, filename)
+                collect(records)
+            return save
 
-                count = 0
-                input = seiscomp3.IO.RecordInput(stream, seiscomp3.Core.Array.INT, seiscomp3.Core.Record.SAVE_RAW)
-                while 1:
-                    try:
-                        rec = input.next()
-                    except:
-                        break
-                    if not rec:
-                        break
+        def request(key, *args):
+            try:
+                self.request(*args)
+            finally:
+                finished.put(("done", key))
+
+        def done(key):
+            return lambda: finished.put(("done", key))
 
-                    count += 1
-                    if sort:
-                        data.append((rec.endTime(), rec.raw().str()))
-                    else:
-                        out.write("%s" % rec.raw().str())
-
-                sys.stderr.write("Read %d records for %d streams\n" % (count, len(netsta_streams[netsta])))
-                if count > 0 or attempt + 1 == number_of_attempts:
-                    break
-                if self.isExitRequested(): return
-                sys.stderr.write("Trying again\n")
-                time.sleep(5)
-
-        if sort:
-            data.sort()
-
-        if sort:
-            # finally write sorted data and ensure uniqueness
-            previous = None
-            for endTime, raw in data:
-                if previous is not None and raw[6:] == previous[6:]:
-                    # unfortunately duplicates do happen sometimes
+        windows = [(t1, t2)]
+        if chunk:
+            windows = split_window(t1, t2, chunk)
+        if self.cache_dir:
+            checkpoint_dir = None
+        if checkpoint_dir and not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        try:
+            pool = RequestPool(self.request_limits)
+            netsta_keys = netsta_streams.keys()
+            netsta_keys.sort()
+            njobs = resumed = 0
+            # request the windows in time order so the output can be
+            # written while the later windows are fetched
+            for w1, w2 in windows:
+                for netsta in netsta_keys:
+                    njobs += 1
+                    save = collect
+                    if checkpoint_dir:
+                        name = netsta if isinstance(netsta, str) else '.'.join(netsta)
+                        filename = os.path.join(checkpoint_dir, "%s-%s-%s.mseed" % (name, w1.toString("%Y%m%dT%H%M%S"), w2.toString("%Y%m%dT%H%M%S")))
+                        if os.path.exists(filename):
+                            output.add(read_records(filename))
+                            resumed += 1
+                            continue
+                        save = checkpoint(filename)
+                    key = (netsta, epoch(w1))
+                    output.register(key, epoch(w1))
+                    streams = netsta_streams[netsta]
+                    if len(self.sources) == 1:
+                        url = self.sources[0]
+                        pool.add(url, request, key, url, streams, w1, w2, save)
+                        continue
+                    merger = SourceMerger(len(self.sources), save, done(key))
+                    for i, url in enumerate(self.sources):
+                        pool.add(url, merger.request, self.request, url, streams, w1, w2, merger.collector(i))
+            if resumed:
+                sys.stderr.write("Resuming: %d of %d requests already done in %s\n" % (resumed, njobs, checkpoint_dir))
+            output.flush()
+            pool.start()
+            running = njobs - resumed
+            while running:
+                try:
+                    kind, value = finished.get(timeout=1)
+                except Queue.Empty:
                     continue
-                out.write("%s" % raw)
-                previous = raw
+                if kind == "records":
+                    output.add(value)
+                else:
+                    output.done(value)
+                    running -= 1
+            pool.join()
+            if self.isExitRequested(): return False
+            if pool.failed:
+                sys.stderr.write("%d of %d requests failed\n" % (pool.failed, len(pool)))
+                if checkpoint_dir:
+                    sys.stderr.write("Run again to retry the missing chunks\n")
+                return False
+
+            output.close()
+            dedup.report()
+
+            if checkpoint_dir:
+                shutil.rmtree(checkpoint_dir)
+            return True
+        finally:
+            if output.sorter is not None:
+                output.sorter.close()
 
 
     def dump(self, eventID, start=None, end=None, radius = max_station_distance_km):
@@ -207,15 +1068,46 @@ class DumperApp(seiscomp3.Client.Application):
                     out = "%s-sorted-mseed" % (filename)
                 else:
                     out = "%s-unsorted-mseed" % (filename)
+                checkpoint_dir = out + ".chunks"
                 out = file(out, 'w')
-                self.get_and_write_data(start, end, out)
-                return True
+                ok = self.get_and_write_data(start, end, out, chunk=self.chunk, checkpoint_dir=checkpoint_dir)
+                return self.finish_output(out, ok)
             except:
                 info = traceback.format_exception(*sys.exc_info())
                 for i in info: sys.stderr.write(i)
                 return False
 
-        self._dbq = self.query()
+        org, mag = self.load_event(eventID)
+        return self.dump_event(eventID, org, mag, radius)
+
+    def finish_output(self, out, ok):
+        """
+        Close the file *out* written by get_and_write_data(), which returned
+        *ok*. Incomplete files are not left to be played back: if the dump
+        was interrupted the records written so far, all records before the
+        time up to which every request had finished, are kept in
+        '<name>.partial', otherwise the file is removed.
+        """
+        out.close()
+        partial = out.name + ".partial"
+        if ok:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            return True
+        if self.isExitRequested() and os.path.getsize(out.name):
+            os.rename(out.name, partial)
+            sys.stderr.write("Interrupted, the data written so far is in %s\n" % partial)
+        else:
+            sys.stderr.write("Incomplete data, removing %s\n" % out.name)
+            os.unlink(out.name)
+        return False
+
+    def load_event(self, eventID):
+        """
+        Return the preferred origin and magnitude of an event.
+        """
+        if self._dbq is None:
+            self._dbq = self.query()
         evt = self._dbq.loadObject(seiscomp3.DataModel.Event.TypeInfo(), eventID)
         evt = seiscomp3.DataModel.Event.Cast(evt)
         if evt is None:
@@ -228,7 +1120,13 @@ class DumperApp(seiscomp3.Client.Application):
         magID = evt.preferredMagnitudeID()
         mag = self._dbq.loadObject(seiscomp3.DataModel.Magnitude.TypeInfo(), magID)
         mag = seiscomp3.DataModel.Magnitude.Cast(mag)
+        return org, mag
+
+    def event_window(self, org):
+        t0 = org.time().value()
+        return t0 + seiscomp3.Core.TimeSpan(-before), t0 + seiscomp3.Core.TimeSpan(after)
 
+    def dump_event(self, eventID, org, mag, radius = max_station_distance_km):
 #        now = seiscomp3.Core.Time.GMT()
         try:
             val = mag.magnitude().value()
@@ -240,11 +1138,12 @@ class DumperApp(seiscomp3.Client.Application):
                 out = "%s-M%3.1f.unsorted-mseed" % (filename, val)
             out = file(out, "w")
 
-            t0 = org.time().value()
-            t1, t2 = t0 + seiscomp3.Core.TimeSpan(-before), t0 + seiscomp3.Core.TimeSpan(after)
+            t1, t2 = self.event_window(org)
 
-            self.get_and_write_data(t1, t2, out, org, radius)
-            print(t1,t0,t2)
+            ok = self.get_and_write_data(t1, t2, out, org, radius)
+            if not self.finish_output(out, ok):
+                return False
+            print(t1,org.time().value(),t2)
             return True
 
         except:
@@ -252,10 +1151,104 @@ class DumperApp(seiscomp3.Client.Application):
             for i in info: sys.stderr.write(i)
             return False
 
+    def dump_events(self, eventIDs, radius = max_station_distance_km):
+        """
+        Dump several events in one go.
+
+        All events are loaded first. Then the time windows of all events
+        are merged per stream and requested together, so data shared by
+        events close in time and space is only fetched once. The records
+        are kept in the waveform cache of every source (a temporary one if
+        none is configured), from which the file of every event is written.
+        """
+        events = []
+        ok = True
+        for eventID in eventIDs:
+            try:
+                org, mag = self.load_event(eventID)
+            except:
+                info = traceback.format_exception(*sys.exc_info())
+                for i in info: sys.stderr.write(i)
+                ok = False
+                continue
+            events.append((eventID, org, mag))
+
+        # time windows of every stream over all events
+        windows = {}
+        for eventID, org, mag in events:
+            t1, t2 = self.event_window(org)
+            for stream in getCurrentStreams(self.stationTable(), t1, org, radius):
+                if component_whitelist and stream[3][-1] not in component_whitelist:
+                    continue
+                windows.setdefault(stream, []).append((epoch(t1), epoch(t2)))
+
+        # request streams of the same network (or station) with the same
+        # merged time window together
+        requests = {}
+        for stream, ranges in windows.iteritems():
+            netsta = stream[0]
+            if self.per_station:
+                netsta = stream[:2]
+            for r1, r2 in merge_ranges(ranges):
+                requests.setdefault((netsta, r1, r2), []).append(stream)
+        sys.stderr.write("Requesting data of %d events with %d requests\n" % (len(events), len(requests)))
+
+        tmpdir = None
+        if not self.cache_dir:
+            tmpdir = self.cache_dir = tempfile.mkdtemp(prefix="cache-", dir=os.getcwd())
+        try:
+            pool = RequestPool(self.request_limits)
+            for (netsta, r1, r2), streams in sorted(requests.iteritems()):
+                for url in self.sources:
+                    pool.add(url, self.request, url, sorted(streams), to_time(r1), to_time(r2), None)
+            pool.run()
+            if self.isExitRequested(): return False
+            if pool.failed:
+                sys.stderr.write("%d of %d requests failed\n" % (pool.failed, len(pool)))
+                ok = False
+
+            for eventID, org, mag in events:
+                if self.isExitRequested(): return False
+                if not self.dump_event(eventID, org, mag, radius):
+                    ok = False
+        finally:
+            if tmpdir is not None:
+                self.cache_dir = None
+                self.caches = {}
+                shutil.rmtree(tmpdir)
+        return ok
+
     def run(self):
         try:
             if self.commandline().hasOption("unsorted"):
                 sort = False
+            self.request_limits = {None: max_requests}
+            if self.commandline().hasOption("max-requests"):
+                self.request_limits = parse_request_limits(self.commandline().optionString("max-requests"))
+            self.per_station = self.commandline().hasOption("per-station")
+            self.chunk = chunk_length
+            if self.commandline().hasOption("chunk"):
+                self.chunk = float(self.commandline().optionString("chunk"))
+            self.stations = None
+            self._dbq = None
+            self.inventory_cache = inventory_cache
+            if self.commandline().hasOption("inventory-cache"):
+                self.inventory_cache = self.commandline().optionString("inventory-cache")
+            self.sources = [self.recordStreamURL()]
+            if self.commandline().hasOption("sources"):
+                self.sources = self.commandline().optionString("sources").split()
+            self.cache_dir = None
+            self.caches = {}
+            if self.commandline().hasOption("cache"):
+                self.cache_dir = self.commandline().optionString("cache")
+            self.sort_memory = sort_memory
+            if self.commandline().hasOption("sort-memory"):
+                self.sort_memory = int(float(self.commandline().optionString("sort-memory")) * 1024 * 1024)
+            self.attempts = number_of_attempts
+            if self.commandline().hasOption('start') and self.commandline().hasOption('end'):
+                self.attempts = 3
+            if self.commandline().hasOption("attempts"):
+                self.attempts = int(self.commandline().optionString("attempts"))
             radius = max_station_distance_km
             if self.commandline().hasOption("radius"):
                 radius = float(self.commandline().optionString("radius"))
@@ -266,13 +1259,24 @@ class DumperApp(seiscomp3.Client.Application):
                 endtime = seiscomp3.Core.Time.FromString(endstring, "%FT%T")
                 if not self.dump(None, start=starttime, end=endtime):
                     return False
+            elif self.commandline().hasOption("events"):
+                filename = self.commandline().optionString("events")
+                f = sys.stdin if filename == "-" else open(filename)
+                evids = [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+                if not self.dump_events(evids, radius=radius):
+                    return False
             elif self.commandline().hasOption("event"):
-                evid = self.commandline().optionString("event")
-                if not self.dump(evid,radius=radius):
+                evids = self.commandline().optionString("event").split(",")
+                if len(evids) > 1:
+                    if not self.dump_events(evids, radius=radius):
+                        return False
+                elif not self.dump(evids[0],radius=radius):
                     return False
             else:
-                sys.stderr.write("Either --start and --end or --event need to be provided.")
+                sys.stderr.write("Either --start and --end, --event or --events need to be provided.")
                 return False
+            for cache in self.caches.itervalues():
+                sys.stderr.write("Waveform cache %s: %d of %d requests served without fetching\n" % (cache.root, cache.hits, cache.requests))
 
         except:
             info = traceback.format_exception(*sys.exc_info())
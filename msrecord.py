@@ -0,0 +1,794 @@
+"""
+Lightweight access to MiniSEED records that only decodes the fields of the
+fixed header needed for playbacks (stream ID, start time, number of samples,
+sampling rate and record length). The raw record bytes are never
+re-serialized, which makes it possible to forward records unchanged or to
+only rewrite the start time in place.
+"""
+
+import array
+import bisect
+import calendar
+import heapq
+import mmap
+import os
+import struct
+import sys
+import time
+
+
+FIXED_HEADER_LEN = 48
+# records are at least 128 bytes long and blockette 1000 has to be within
+# the first 128 bytes in practice
+MIN_RECLEN = 128
+BTIME_OFFSET = 20
+
+_fixed_header = {
+    '>': struct.Struct('>6scc5s2s3s2sHHBBBxHHhhBBBBlHH'),
+    '<': struct.Struct('<6scc5s2s3s2sHHBBBxHHhhBBBBlHH'),
+}
+_btime = {
+    '>': struct.Struct('>HHBBBxH'),
+    '<': struct.Struct('<HHBBBxH'),
+}
+_blockette_head = {
+    '>': struct.Struct('>HH'),
+    '<': struct.Struct('<HH'),
+}
+
+
+class MSeedError(Exception):
+    pass
+
+
+def _typecode(itemsize, candidates):
+    for code in candidates:
+        try:
+            if array.array(code).itemsize == itemsize:
+                return code
+        except ValueError:
+            # e.g. 'q' is not available in Python 2
+            continue
+    raise MSeedError('no array type with %d bytes' % itemsize)
+
+_INT64 = _typecode(8, 'lq')
+_UINT32 = _typecode(4, 'IL')
+
+
+def btime_to_ticks(year, doy, hour, minute, second, tms):
+    """
+    Convert the fields of a BTIME structure to 1/10000 s since 1970.
+    """
+    secs = calendar.timegm((year, 1, 1, hour, minute, second, 0, 0, 0))
+    return (secs + (doy - 1) * 86400) * 10000 + tms
+
+
+def ticks_to_btime(ticks):
+    """
+    Convert 1/10000 s since 1970 to the fields of a BTIME structure.
+    """
+    secs, tms = divmod(ticks, 10000)
+    t = time.gmtime(secs)
+    return t.tm_year, t.tm_yday, t.tm_hour, t.tm_min, t.tm_sec, tms
+
+
+def sample_rate(factor, multiplier):
+    """
+    Compute the sampling rate from the fixed header rate factor and
+    multiplier as defined by the SEED manual.
+    """
+    if factor > 0 and multiplier > 0:
+        return float(factor) * multiplier
+    if factor > 0 and multiplier < 0:
+        return -float(factor) / multiplier
+    if factor < 0 and multiplier > 0:
+        return -float(multiplier) / factor
+    if factor < 0 and multiplier < 0:
+        return 1. / (float(factor) * multiplier)
+    return 0.
+
+
+def byte_order(data, offset=0):
+    """
+    Guess the byte order of a record from the year of its start time.
+    """
+    year = struct.unpack_from('>H', data, offset + BTIME_OFFSET)[0]
+    if 1900 <= year <= 2100:
+        return '>'
+    return '<'
+
+
+class Record(object):
+    """
+    A MiniSEED record that is a view on *size* bytes at *offset* of *data*
+    and decodes the fixed header only once.
+
+    *data* may be any object supporting the buffer interface, e.g. a
+    bytearray or a memory-mapped file. Times are given in seconds since
+    1970; *end* is the time following the last sample, like
+    Record.endTime() in SeisComP3.
+    """
+
+    __slots__ = ('data', 'offset', 'order', 'net', 'sta', 'loc', 'cha',
+                 'ticks', 'usec', 'nsamp', 'fsamp', 'size')
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+        self.order = order = byte_order(data, offset)
+        (seq, quality, reserved, sta, loc, cha, net, year, doy, hour, minute,
+         second, tms, nsamp, factor, multiplier, aflags, ioflags, qflags,
+         nblk, correction, pdata, pblk) = \
+            _fixed_header[order].unpack_from(data, offset)
+        self.net = net.strip()
+        self.sta = sta.strip()
+        self.loc = loc.strip()
+        self.cha = cha.strip()
+        self.nsamp = nsamp
+        self.fsamp = sample_rate(factor, multiplier)
+        self.ticks = btime_to_ticks(year, doy, hour, minute, second, tms)
+        if correction and not aflags & 0x02:
+            self.ticks += correction
+        self.usec = 0
+        self.size = None
+        while pblk:
+            btype, pnext = _blockette_head[order].unpack_from(data,
+                                                              offset + pblk)
+            if btype == 1000:
+                self.size = 1 << struct.unpack_from('B', data,
+                                                    offset + pblk + 6)[0]
+            elif btype == 1001:
+                self.usec = struct.unpack_from('b', data, offset + pblk + 5)[0]
+            if pnext <= pblk:
+                break
+            pblk = pnext
+        if self.size is None:
+            raise MSeedError('%s.%s.%s.%s: no blockette 1000' %
+                             (self.net, self.sta, self.loc, self.cha))
+
+    def stream_id(self):
+        return '%s.%s.%s.%s' % (self.net, self.sta, self.loc, self.cha)
+
+    def blockette(self, btype):
+        """
+        Return the position of the first blockette of type *btype* within
+        *data*, or None.
+        """
+        pblk = _fixed_header[self.order].unpack_from(self.data,
+                                                     self.offset)[-1]
+        while pblk:
+            pos = self.offset + pblk
+            t, pnext = _blockette_head[self.order].unpack_from(self.data, pos)
+            if t == btype:
+                return pos
+            if pnext <= pblk:
+                break
+            pblk = pnext
+        return None
+
+    @property
+    def begin(self):
+        return self.ticks * 1e-4 + self.usec * 1e-6
+
+    @property
+    def end(self):
+        if not self.fsamp:
+            return self.begin
+        return self.begin + self.nsamp / self.fsamp
+
+    def raw(self):
+        """
+        Return the bytes of the record without copying them.
+        """
+        return buffer(self.data, self.offset, self.size)
+
+    def copy(self):
+        """
+        Return a record backed by its own writable copy of the bytes, e.g.
+        before calling shift() on a record from a memory-mapped file.
+        """
+        rec = Record.__new__(Record)
+        for name in Record.__slots__:
+            setattr(rec, name, getattr(self, name))
+        rec.data = bytearray(self.raw())
+        rec.offset = 0
+        return rec
+
+    def shift(self, seconds):
+        """
+        Move the record in time by rewriting the BTIME field of the fixed
+        header in place. *data* has to be writable, e.g. a bytearray. The
+        shift is rounded to the 1/10000 s resolution of BTIME.
+        """
+        ticks = int(round(seconds * 1e4))
+        pos = self.offset + BTIME_OFFSET
+        year, doy, hour, minute, second, tms = \
+            _btime[self.order].unpack_from(self.data, pos)
+        btime = btime_to_ticks(year, doy, hour, minute, second, tms) + ticks
+        _btime[self.order].pack_into(self.data, pos, *ticks_to_btime(btime))
+        self.ticks += ticks
+
+
+def read_records(f):
+    """
+    Iterate over the records in the file object *f* without seeking, so
+    that pipes and standard input work as well. Each record is read into
+    its own bytearray which can be patched in place.
+    """
+    while True:
+        head = f.read(MIN_RECLEN)
+        if not head:
+            return
+        if len(head) < MIN_RECLEN:
+            raise MSeedError('truncated record at end of file')
+        data = bytearray(head)
+        rec = Record(data)
+        if rec.size > MIN_RECLEN:
+            tail = f.read(rec.size - MIN_RECLEN)
+            if len(tail) < rec.size - MIN_RECLEN:
+                raise MSeedError('truncated record at end of file')
+            data.extend(tail)
+        yield rec
+
+
+class MSeedFile(object):
+    """
+    Memory-map a MiniSEED file and iterate over its records.
+
+    Records are views on the mapped file, so only the pages that are
+    actually needed are read and no record bytes are copied.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = os.path.getsize(filename)
+        self.mmap = None
+        if self.size:
+            f = open(filename, 'rb')
+            try:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+
+    def record(self, offset):
+        """
+        Return the record starting at byte *offset*.
+        """
+        rec = Record(self.mmap, offset)
+        if offset + rec.size > self.size:
+            raise MSeedError('%s: truncated record at offset %d' %
+                             (self.filename, offset))
+        return rec
+
+    def records(self, offset=0):
+        while offset + FIXED_HEADER_LEN <= self.size:
+            rec = self.record(offset)
+            yield rec
+            offset += rec.size
+
+    def __iter__(self):
+        return self.records()
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+
+def _mtime(st):
+    return int(round(st.st_mtime * 1e6))
+
+
+class RecordIndex(object):
+    """
+    Per-record index of a MiniSEED file that is stored next to it in a
+    sidecar file ('<filename>.idx').
+
+    For every record the index holds the file offset, the stream (as a
+    position in *streams*), start and end time in microseconds since 1970,
+    the number of samples and the sampling rate, each in its own array so
+    the whole index can be loaded with a few reads. The sidecar is rebuilt
+    automatically if the size or the modification time of the MiniSEED
+    file no longer match.
+    """
+
+    magic = 'MSIDX'
+    version = 1
+    columns = (('offset', _INT64), ('stream', _UINT32), ('start', _INT64),
+               ('end', _INT64), ('nsamp', _UINT32), ('fsamp', 'd'))
+    layout = '%s %s' % (sys.byteorder,
+                        ','.join(code for name, code in columns))
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fsize = None
+        self.mtime = None
+        self.sorted = True
+        self.streams = []
+        for name, code in self.columns:
+            setattr(self, name, array.array(code))
+
+    def __len__(self):
+        return len(self.offset)
+
+    @staticmethod
+    def sidecar(filename):
+        return filename + '.idx'
+
+    @classmethod
+    def build(cls, filename):
+        """
+        Scan the headers of all records in *filename*.
+        """
+        idx = cls(filename)
+        st = os.stat(filename)
+        idx.fsize, idx.mtime = st.st_size, _mtime(st)
+        ids = {}
+        wf = MSeedFile(filename)
+        try:
+            for rec in wf:
+                sid = rec.stream_id()
+                n = ids.get(sid)
+                if n is None:
+                    n = ids[sid] = len(idx.streams)
+                    idx.streams.append(sid)
+                start = rec.ticks * 100 + rec.usec
+                end = start
+                if rec.fsamp:
+                    end += int(round(rec.nsamp * 1e6 / rec.fsamp))
+                if idx.end and end < idx.end[-1]:
+                    idx.sorted = False
+                idx.offset.append(rec.offset)
+                idx.stream.append(n)
+                idx.start.append(start)
+                idx.end.append(end)
+                idx.nsamp.append(rec.nsamp)
+                idx.fsamp.append(rec.fsamp)
+        finally:
+            wf.close()
+        return idx
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load the sidecar index of *filename*. Returns None if there is no
+        index or if it is out of date.
+        """
+        try:
+            f = open(cls.sidecar(filename), 'rb')
+        except IOError:
+            return None
+        try:
+            st = os.stat(filename)
+            if f.readline().split() != [cls.magic, str(cls.version)]:
+                return None
+            if f.readline().rstrip('\n') != cls.layout:
+                return None
+            fsize, mtime, count, nstreams, is_sorted = \
+                [int(x) for x in f.readline().split()]
+            if fsize != st.st_size or mtime != _mtime(st):
+                return None
+            idx = cls(filename)
+            idx.fsize, idx.mtime, idx.sorted = fsize, mtime, bool(is_sorted)
+            idx.streams = [f.readline().rstrip('\n') for i in xrange(nstreams)]
+            for name, code in cls.columns:
+                getattr(idx, name).fromfile(f, count)
+            return idx
+        except (ValueError, EOFError):
+            return None
+        finally:
+            f.close()
+
+    def save(self):
+        """
+        Write the sidecar file. The index is written to a temporary file
+        first so that concurrent readers never see a partial index.
+        """
+        path = self.sidecar(self.filename)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        f = open(tmp, 'wb')
+        try:
+            f.write('%s %d\n' % (self.magic, self.version))
+            f.write('%s\n' % self.layout)
+            f.write('%d %d %d %d %d\n' % (self.fsize, self.mtime, len(self),
+                                          len(self.streams), self.sorted))
+            for sid in self.streams:
+                f.write('%s\n' % sid)
+            for name, code in self.columns:
+                getattr(self, name).tofile(f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    @classmethod
+    def open(cls, filename):
+        """
+        Return the index of *filename*, building and saving it if the
+        sidecar is missing or stale.
+        """
+        idx = cls.load(filename)
+        if idx is None:
+            idx = cls.build(filename)
+            try:
+                idx.save()
+            except (IOError, OSError), e:
+                sys.stderr.write('Cannot save index of %s: %s\n' %
+                                 (filename, e))
+        return idx
+
+    def earliest_end(self):
+        """
+        Return the earliest end time in seconds since 1970 or None if the
+        file is empty.
+        """
+        if not len(self):
+            return None
+        if self.sorted:
+            return self.end[0] * 1e-6
+        return min(self.end) * 1e-6
+
+    def skip(self, seconds):
+        """
+        Return the position of the first record that ends at least
+        *seconds* after the first record of the file.
+        """
+        if not len(self):
+            return 0
+        threshold = self.end[0] + int(round(seconds * 1e6))
+        if self.sorted:
+            return bisect.bisect_left(self.end, threshold)
+        for i, end in enumerate(self.end):
+            if end >= threshold:
+                return i
+        return len(self)
+
+
+def expand_paths(paths):
+    """
+    Return all MiniSEED files given by *paths*. Directories are searched
+    recursively; index sidecars and empty files are skipped.
+    """
+    filenames = []
+    for path in paths:
+        if not os.path.isdir(path):
+            filenames.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.idx') or name.endswith('.tmp'):
+                    continue
+                fn = os.path.join(root, name)
+                if os.path.getsize(fn):
+                    filenames.append(fn)
+    return filenames
+
+
+def earliest_end_time(paths):
+    """
+    Return the earliest end time of all records in *paths* (files or
+    directories) in seconds since 1970, or None if there are no records.
+    Only the record indexes are consulted; they are built from the fixed
+    headers if necessary.
+    """
+    tmin = None
+    for fn in expand_paths(paths):
+        t = RecordIndex.open(fn).earliest_end()
+        if t is not None and (tmin is None or t < tmin):
+            tmin = t
+    return tmin
+
+
+def merge_records(iterables):
+    """
+    Merge iterables of records that are each sorted by end time into one
+    iterator sorted by end time. Only the current record of every input is
+    kept in memory.
+    """
+    heap = []
+    for n, it in enumerate(iterables):
+        it = iter(it)
+        for rec in it:
+            heap.append((rec.end, n, rec, it))
+            break
+    heapq.heapify(heap)
+    while heap:
+        end, n, rec, it = heap[0]
+        yield rec
+        for rec in it:
+            heapq.heapreplace(heap, (rec.end, n, rec, it))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+class MergedFiles(object):
+    """
+    Read several MiniSEED files in end time order without writing a merged
+    copy first.
+
+    Files that are not sorted by time are read in the order given by their
+    record index. Records that are already known from another file, i.e.
+    that have the same stream, start time and number of samples, are
+    skipped and counted in *duplicates*.
+    """
+
+    def __init__(self, paths):
+        self.files = [MSeedFile(fn) for fn in expand_paths(paths)]
+        self.duplicates = 0
+
+    def _sorted(self, wf):
+        idx = RecordIndex.open(wf.filename)
+        if idx.sorted:
+            return wf.records()
+        order = sorted(xrange(len(idx)), key=idx.end.__getitem__)
+        return (wf.record(idx.offset[i]) for i in order)
+
+    def __iter__(self):
+        current = None
+        seen = set()
+        for rec in merge_records([self._sorted(wf) for wf in self.files]):
+            # duplicates share the same end time so only records ending at
+            # the current time have to be remembered
+            end = rec.end
+            if end != current:
+                current = end
+                seen.clear()
+            key = (rec.stream_id(), rec.ticks, rec.usec, rec.nsamp)
+            if key in seen:
+                self.duplicates += 1
+                continue
+            seen.add(key)
+            yield rec
+
+    def close(self):
+        for wf in self.files:
+            wf.close()
+
+
+# data encodings (blockette 1000) that reblock() can handle
+INT16, INT32, FLOAT32, FLOAT64, STEIM1, STEIM2 = 1, 3, 4, 5, 10, 11
+_sample_size = {INT16: 2, INT32: 4, FLOAT32: 4, FLOAT64: 8}
+FRAME_LEN = 64
+# the fixed header, blockette 1000 and blockette 1001 fill the first frame
+# of a re-blocked record
+DATA_OFFSET = 64
+
+# how a 32 bit word of differences may be packed: (number of differences,
+# bits per difference, nibble in word 0 of the frame, dnib in the word),
+# densest first
+_steim_packings = {
+    STEIM1: ((4, 8, 1, None), (2, 16, 2, None), (1, 32, 3, None)),
+    STEIM2: ((7, 4, 3, 2), (6, 5, 3, 1), (5, 6, 3, 0), (4, 8, 1, None),
+             (3, 10, 2, 3), (2, 15, 2, 2), (1, 30, 2, 1)),
+}
+_steim_unpackings = {
+    STEIM1: {1: (4, 8), 2: (2, 16), 3: (1, 32)},
+    STEIM2: {1: (4, 8), (2, 1): (1, 30), (2, 2): (2, 15), (2, 3): (3, 10),
+             (3, 0): (5, 6), (3, 1): (6, 5), (3, 2): (7, 4)},
+}
+
+
+def _unpack_diffs(word, n, bits):
+    mask = (1 << bits) - 1
+    sign = 1 << (bits - 1)
+    diffs = []
+    for shift in xrange(bits * (n - 1), -1, -bits):
+        d = (word >> shift) & mask
+        if d & sign:
+            d -= 1 << bits
+        diffs.append(d)
+    return diffs
+
+
+def decode_steim(data, pos, nframes, nsamp, order, encoding):
+    """
+    Decode *nsamp* samples from *nframes* Steim1 or Steim2 frames at
+    *pos* of *data* and check them against the reverse integration
+    constant.
+    """
+    unpackings = _steim_unpackings[encoding]
+    words = struct.unpack_from('%s%dL' % (order, 16 * nframes), data, pos)
+    x0 = xn = None
+    diffs = []
+    for f in xrange(0, len(words), 16):
+        nibbles = words[f]
+        for i in xrange(1, 16):
+            nib = (nibbles >> (30 - 2 * i)) & 3
+            word = words[f + i]
+            if nib == 0:
+                if f == 0 and i == 1:
+                    x0 = word
+                elif f == 0 and i == 2:
+                    xn = word
+                continue
+            if encoding == STEIM2 and nib > 1:
+                nib = (nib, word >> 30)
+            packing = unpackings.get(nib)
+            if packing is None:
+                raise MSeedError('invalid Steim2 difference word')
+            diffs.extend(_unpack_diffs(word, *packing))
+        if len(diffs) >= nsamp:
+            break
+    if x0 is None or xn is None or len(diffs) < nsamp:
+        raise MSeedError('Steim frames hold fewer than %d samples' % nsamp)
+    x0, xn = [x - (1 << 32) if x & 0x80000000 else x for x in (x0, xn)]
+    samples = [x0]
+    x = x0
+    for d in diffs[1:nsamp]:
+        x += d
+        samples.append(x)
+    if samples and x != xn:
+        raise MSeedError('Steim decoding does not match the reverse '
+                         'integration constant')
+    return samples
+
+
+def encode_steim(samples, diffs, start, nframes, order, encoding):
+    """
+    Pack as many of the samples from *start* on into at most *nframes*
+    Steim1 or Steim2 frames as fit. *diffs* holds the difference of every
+    sample to the one before. Return the frames and the number of samples
+    they hold.
+    """
+    packings = _steim_packings[encoding]
+    total = len(samples)
+    i = start
+    words = []
+    for f in xrange(nframes):
+        frame = [0] * 16
+        nibbles = 0
+        for w in xrange(3 if f == 0 else 1, 16):
+            if i >= total:
+                break
+            for n, bits, nib, dnib in packings:
+                if i + n > total:
+                    continue
+                limit = 1 << (bits - 1)
+                for d in diffs[i:i + n]:
+                    if not -limit <= d < limit:
+                        break
+                else:
+                    break
+            else:
+                raise MSeedError('sample difference too large for Steim')
+            mask = (1 << bits) - 1
+            word = 0
+            for d in diffs[i:i + n]:
+                word = (word << bits) | (d & mask)
+            if dnib is not None:
+                word |= dnib << 30
+            frame[w] = word & 0xffffffff
+            nibbles |= nib << (30 - 2 * w)
+            i += n
+        frame[0] = nibbles
+        words.extend(frame)
+        if i >= total:
+            break
+    words[1] = samples[start] & 0xffffffff
+    words[2] = samples[i - 1] & 0xffffffff
+    return struct.pack('%s%dL' % (order, len(words)), *words), i - start
+
+
+def reblock(rec, reclen=512):
+    """
+    Split (or pad) the record *rec* into records of *reclen* bytes.
+
+    Uncompressed data is copied sample by sample, Steim1 and Steim2 data
+    is decoded and encoded again, one record at a time. The new records
+    keep the stream, quality and flags of *rec*; their start times are
+    computed from the sampling rate and written with blockette 1001 to
+    keep microsecond precision. Records of other encodings or without
+    samples are returned unchanged.
+    """
+    if rec.size == reclen or not rec.nsamp or not rec.fsamp:
+        return [rec]
+    data, order = rec.data, rec.order
+    b1000 = rec.blockette(1000)
+    encoding, wordorder = struct.unpack_from('BB', data, b1000 + 4)
+    if encoding not in _sample_size and encoding not in _steim_packings:
+        return [rec]
+    header = list(_fixed_header[order].unpack_from(data, rec.offset))
+    pdata = rec.offset + header[21]
+    dorder = '>' if wordorder else '<'
+    b1001 = rec.blockette(1001)
+    quality = struct.unpack_from('B', data, b1001 + 4)[0] if b1001 else 0
+
+    start = rec.ticks * 100 + rec.usec
+    exponent = reclen.bit_length() - 1
+    nframes = (reclen - DATA_OFFSET) // FRAME_LEN
+    if encoding in _sample_size:
+        width = _sample_size[encoding]
+        samples = diffs = None
+    else:
+        samples = decode_steim(data, pdata, (rec.size - header[21]) //
+                               FRAME_LEN, rec.nsamp, dorder, encoding)
+        diffs = [0] + [b - a for a, b in zip(samples, samples[1:])]
+
+    records = []
+    i = 0
+    while i < rec.nsamp:
+        out = bytearray(reclen)
+        if samples is None:
+            n = min((reclen - DATA_OFFSET) // width, rec.nsamp - i)
+            out[DATA_OFFSET:DATA_OFFSET + n * width] = \
+                data[pdata + i * width:pdata + (i + n) * width]
+            frames = 0
+        else:
+            payload, n = encode_steim(samples, diffs, i, nframes, dorder,
+                                      encoding)
+            out[DATA_OFFSET:DATA_OFFSET + len(payload)] = payload
+            frames = len(payload) // FRAME_LEN
+        ticks, usec = divmod(start + int(round(i * 1e6 / rec.fsamp)), 100)
+        header[7:13] = ticks_to_btime(ticks)
+        header[13] = n
+        header[19] = 2
+        header[20] = 0
+        header[21] = DATA_OFFSET
+        header[22] = FIXED_HEADER_LEN
+        _fixed_header[order].pack_into(out, 0, *header)
+        struct.pack_into(order + 'HHBBBx', out, FIXED_HEADER_LEN, 1000,
+                         FIXED_HEADER_LEN + 8, encoding, wordorder, exponent)
+        struct.pack_into(order + 'HHBbxB', out, FIXED_HEADER_LEN + 8, 1001,
+                         0, quality, usec, frames)
+        records.append(Record(out))
+        i += n
+    return records
+
+
+def reblock_records(records, reclen=512, window=None):
+    """
+    Iterate over *records*, splitting every record that is not *reclen*
+    bytes long with reblock(). Only one input record is decoded at a time.
+    Records that cannot be decoded are passed on unchanged.
+
+    The pieces of a split record end before the record itself. To keep
+    input sorted by end time sorted, every record is held back until no
+    piece of a later record can end before it, i.e. by the length of the
+    longest record split so far, but at most *window* seconds. Pieces that
+    are due earlier than that are passed on at once. In particular, until
+    the first record has been split nothing is held back, so the pieces of
+    the first long record of a stream may come after records that end
+    later.
+    """
+    heap = []
+    seq = 0
+    lookahead = 0.
+    for rec in records:
+        split = [rec]
+        if rec.size != reclen:
+            try:
+                split = reblock(rec, reclen)
+            except MSeedError, e:
+                sys.stderr.write('%s: cannot re-block record: %s\n' %
+                                 (rec.stream_id(), e))
+            if len(split) > 1:
+                lookahead = max(lookahead, rec.end - rec.begin)
+                if window is not None:
+                    lookahead = min(lookahead, window)
+        if not heap and not lookahead:
+            # nothing split yet, no need to reorder
+            for r in split:
+                yield r
+            continue
+        for r in split:
+            heapq.heappush(heap, (r.end, seq, r))
+            seq += 1
+        horizon = rec.end - lookahead
+        while heap and heap[0][0] <= horizon:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+if __name__ == '__main__':
+    # print the earliest end time of the given files, e.g. for playback.sh
+    import datetime
+    if len(sys.argv) < 2:
+        sys.stderr.write('Usage: %s <file or directory> ...\n' % sys.argv[0])
+        sys.exit(1)
+    tmin = earliest_end_time(sys.argv[1:])
+    if tmin is None:
+        print datetime.datetime.utcnow()
+    else:
+        print datetime.datetime.utcfromtimestamp(tmin)
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
-import sys, os, time, datetime, calendar, stat
+import sys, os, time, datetime, calendar, stat, errno, fcntl, select, socket
+import json
 from   getopt import getopt, GetoptError
-from seiscomp import mseedlite as mseed
+import msrecord
 
 tstart = datetime.datetime.utcnow()
 ifile = sys.stdin
@@ -10,11 +11,53 @@ verbosity = 0
 speed = 1.
 jump = 0
 test = False
+afap = False
 mode = 'realtime'
 starttime = None
 legalrecsize = 512
+tick = 0.01
+batch = 128
+window = 600.
+maxbuf = 4 * 1024 * 1024
+statsfile = None
+statsinterval = 10.
 
-def read_mseed_with_delays(delaydict, reciterable):
+
+def _monotonic_clock():
+    """
+    Return a function reading a clock that cannot go backwards.
+
+    Python 2 has no time.monotonic so we call clock_gettime(CLOCK_MONOTONIC)
+    through ctypes and only fall back to the wall clock if that fails.
+    """
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes, ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        ts = timespec()
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except Exception:
+        return time.time
+
+monotonic = _monotonic_clock()
+
+
+def read_mseed_with_delays(delaydict, reciterable, window=None, source=None):
     """
         Create an iterator which takes into account configurable realistic delays.
 
@@ -30,97 +73,679 @@ def read_mseed_with_delays(delaydict, reciterable):
         This function will rearrange the iterable object which has been used as input for rt_simul() so that it can again be used by rt_simul
         but taking artificial delays into account.
 
+        Records are held back in a heap until no record further down the (time sorted) input can be released before them. Delays are
+        capped at *window* seconds so the heap never holds more than *window* seconds of data. If *source* is the msrecord.MSeedFile the
+        records come from, the heap only keeps the file offsets of records that are views on it and the records are looked up again
+        when they are released. Records still in the heap when the input is exhausted are released in order.
+
     """
-    import time
     import heapq
-    import itertools
 
     heap = []
-    min_delay = 0
     default_delay = 0
     if 'default' in delaydict:
         default_delay = delaydict['default']
-    reciterator = itertools.chain(reciterable)
-    rec = reciterator.next()
-    while rec:
-        rec_time = calendar.timegm(rec.end_time.timetuple())
-        delay_time = rec_time
+    delays = [default_delay] + [v for k, v in delaydict.iteritems() if k != 'default']
+    if window is not None:
+        delays = [min(d, window) for d in delays]
+    # no record read later can be released before its end time + min_delay
+    min_delay = min(delays)
+    seq = 0
+    peak = 0
+    clipped = 0
+    late_max = 0.
+    late_total = 0.
+    released = 0
+    for rec in reciterable:
+        rec_time = rec.end
         stationname = "%s.%s" % (rec.net, rec.sta)
-        if stationname in delaydict:
-            delay_time = rec_time + delaydict[stationname]
+        delay = delaydict.get(stationname, default_delay)
+        if window is not None and delay > window:
+            delay = window
+            clipped += 1
+        # seq keeps records with the same release time in input order
+        if source is not None and rec.data is source.mmap:
+            heapq.heappush(heap, (rec_time + delay, seq, rec.offset))
         else:
-            delay_time = rec_time + default_delay
-        heapq.heappush(heap, (delay_time, rec))
-        toprectime = heap[0][0]
-        if toprectime - min_delay < rec_time:
-            topelement = heapq.heappop(heap)
-            yield topelement
-        rec = reciterator.next()
+            heapq.heappush(heap, (rec_time + delay, seq, rec))
+        seq += 1
+        peak = max(peak, len(heap))
+        horizon = rec_time + min_delay
+        while heap and heap[0][0] <= horizon:
+            delay_time, _, item = heapq.heappop(heap)
+            late = horizon - delay_time
+            late_max = max(late_max, late)
+            late_total += late
+            released += 1
+            if not isinstance(item, msrecord.Record):
+                item = source.record(item)
+            yield delay_time, item
+    while heap:
+        delay_time, _, item = heapq.heappop(heap)
+        if not isinstance(item, msrecord.Record):
+            item = source.record(item)
+        yield delay_time, item
+    sys.stderr.write("Delay buffer: peak %d records, %d delays capped at "
+                     "%s s, release lateness mean %.3f s max %.3f s\n" %
+                     (peak, clipped, window, late_total / max(released, 1),
+                      late_max))
+
+
+class SendTimeStats(object):
+    """
+    Collect the send-time error (intended minus actual send time) of every
+    record.
 
+    Errors are binned in 0.1 ms steps so that the memory used does not grow
+    with the length of the playback. Positive values mean that a record left
+    early, negative values that it left late.
+    """
 
-def rt_simul(f, speed=1., jump=0, delaydict=None):
+    binwidth = 1e-4
+
+    def __init__(self):
+        self.bins = {}
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def add(self, error):
+        key = int(round(error / self.binwidth))
+        self.bins[key] = self.bins.get(key, 0) + 1
+        self.count += 1
+        self.total += error
+        if self.min is None or error < self.min:
+            self.min = error
+        if self.max is None or error > self.max:
+            self.max = error
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = int(round(q / 100. * (self.count - 1)))
+        seen = 0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return key * self.binwidth
+        return self.max
+
+    def report(self):
+        if not self.count:
+            return
+        sys.stderr.write("Send-time error [ms] (intended - actual) for %d "
+                         "records: mean %.3f min %.3f p1 %.3f p50 %.3f "
+                         "p99 %.3f max %.3f\n" %
+                         (self.count, 1e3 * self.total / self.count,
+                          1e3 * self.min, 1e3 * self.percentile(1),
+                          1e3 * self.percentile(50),
+                          1e3 * self.percentile(99), 1e3 * self.max))
+
+
+class Telemetry(object):
+    """
+    Cheap counters describing how a playback went, written every *interval*
+    seconds to *filename*.
+
+    Records, bytes and dropped records are counted per stream. Together
+    with the time spent sleeping, the scheduling lateness (from the
+    SendTimeStats *pacing*) and the delay applied to every station they are
+    appended as one JSON object per line, or, if *filename* ends with
+    '.prom', written in the Prometheus text format (replacing the previous
+    contents, e.g. for the node exporter's textfile collector).
     """
-    Iterator to simulate "real-time" MSeed input
 
-    At startup, the first MSeed record is read. The following records are
-    read in pseudo-real-time relative to the time of the first record,
-    resulting in data flowing at realistic speed. This is useful e.g. for
-    demonstrating real-time processing using real data of past events.
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10.)
+
+    def __init__(self, filename, interval=10., pacing=None, delaydict=None,
+                 window=None):
+        self.filename = filename
+        self.interval = interval
+        self.pacing = pacing
+        self.delaydict = delaydict or {}
+        self.window = window
+        self.streams = {}
+        self.slept = 0.
+        self.tstart = monotonic()
+        self.next = self.tstart + interval
+
+    def _counters(self, rec):
+        key = (rec.net, rec.sta, rec.loc, rec.cha)
+        counters = self.streams.get(key)
+        if counters is None:
+            counters = self.streams[key] = [0, 0, 0]
+        return counters
+
+    def sent(self, rec):
+        counters = self._counters(rec)
+        counters[0] += 1
+        counters[1] += rec.size
+        if monotonic() >= self.next:
+            self.dump()
+
+    def dropped(self, rec):
+        self._counters(rec)[2] += 1
+
+    def sleeper(self, sleep):
+        """
+        Wrap the function *sleep* to account for the time spent in it.
+        """
+        def wrapper(seconds):
+            t = monotonic()
+            sleep(seconds)
+            self.slept += monotonic() - t
+        return wrapper
+
+    def delays(self):
+        if not self.delaydict:
+            return {}
+        default = self.delaydict.get('default', 0)
+        result = {}
+        for net, sta, loc, cha in self.streams:
+            name = '%s.%s' % (net, sta)
+            delay = self.delaydict.get(name, default)
+            if self.window is not None:
+                delay = min(delay, self.window)
+            result[name] = delay
+        return result
+
+    def lateness(self):
+        """
+        Return a cumulative histogram of how late records were sent.
+        """
+        counts = [0] * len(self.buckets)
+        if self.pacing is None:
+            return counts, 0, 0.
+        for key, n in self.pacing.bins.iteritems():
+            late = -key * self.pacing.binwidth
+            for i, le in enumerate(self.buckets):
+                if late <= le:
+                    counts[i] += n
+        return counts, self.pacing.count, -self.pacing.total
+
+    def dump(self):
+        self.next = monotonic() + self.interval
+        if self.filename.endswith('.prom'):
+            self._write_prometheus()
+        else:
+            self._write_json()
+
+    def _write_json(self):
+        counts, count, total = self.lateness()
+        streams = {}
+        for key, (nrec, nbytes, ndropped) in self.streams.iteritems():
+            streams['.'.join(key)] = {'records': nrec, 'bytes': nbytes,
+                                      'dropped': ndropped}
+        line = {'time': datetime.datetime.utcnow().isoformat(),
+                'elapsed': monotonic() - self.tstart,
+                'sleep': self.slept,
+                'lateness': {'count': count, 'sum': total,
+                             'buckets': dict(zip(self.buckets, counts))},
+                'delays': self.delays(),
+                'streams': streams}
+        f = open(self.filename, 'a')
+        try:
+            f.write(json.dumps(line, sort_keys=True) + '\n')
+        finally:
+            f.close()
+
+    def _write_prometheus(self):
+        lines = []
+
+        def metric(name, kind, doc, samples):
+            lines.append('# HELP msrtsimul_%s %s' % (name, doc))
+            lines.append('# TYPE msrtsimul_%s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('msrtsimul_%s%s %s' % (name, labels, value))
+
+        streams = sorted(self.streams.iteritems())
+        for i, (name, doc) in enumerate((
+                ('records_total', 'Records sent per stream.'),
+                ('bytes_total', 'Bytes sent per stream.'),
+                ('dropped_records_total', 'Records dropped per stream.'))):
+            metric(name, 'counter', doc,
+                   [('{stream="%s"}' % '.'.join(key), c[i])
+                    for key, c in streams])
+        metric('sleep_seconds_total', 'counter', 'Time spent sleeping.',
+               [('', self.slept)])
+        metric('station_delay_seconds', 'gauge', 'Delay applied per station.',
+               [('{station="%s"}' % k, v)
+                for k, v in sorted(self.delays().iteritems())])
+        counts, count, total = self.lateness()
+        metric('lateness_seconds', 'histogram',
+               'Actual minus intended send time of records.',
+               [('_bucket{le="%g"}' % le, n)
+                for le, n in zip(self.buckets, counts)] +
+               [('_bucket{le="+Inf"}', count), ('_sum', total),
+                ('_count', count)])
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+        f = open(tmp, 'w')
+        try:
+            f.write('\n'.join(lines) + '\n')
+        finally:
+            f.close()
+        os.rename(tmp, self.filename)
 
-    The data in the input file may be multiplexed, but *must* be sorted by
-    time, e.g. using 'mssort'.
+
+class Sink(object):
+    """
+    A non-blocking output for records with its own buffer.
+
+    Data that cannot be written right away stays in the buffer and is
+    written whenever the descriptor becomes writable again. The number of
+    writes, the number of times the consumer was not ready (stalls), the
+    peak buffer size and the time the playback had to wait because the
+    buffer was full are kept for the report.
     """
-    import time
 
-    rtime = time.time()
+    def __init__(self, name, fd, maxbuf=maxbuf, blocking=False, handle=None):
+        self.name = name
+        self.fd = fd
+        self.maxbuf = maxbuf
+        # keep e.g. the socket object alive as long as we use its descriptor
+        self.handle = handle
+        if not blocking:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.buf = bytearray()
+        self.nbytes = 0
+        self.syscalls = 0
+        self.stalls = 0
+        self.peak = 0
+        self.blocked = 0.
+
+    def pending(self):
+        return len(self.buf)
+
+    def push(self, data):
+        self.buf += data
+        self.peak = max(self.peak, len(self.buf))
+
+    def pump(self):
+        """
+        Write as much of the buffer as possible without blocking.
+        """
+        while self.buf:
+            try:
+                n = os.write(self.fd, self.buf)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.stalls += 1
+                    return
+                raise
+            self.syscalls += 1
+            self.nbytes += n
+            del self.buf[:n]
+
+    def report(self):
+        sys.stderr.write("Output %s: %d bytes in %d writes, %d stalls, "
+                         "peak buffer %d bytes, blocked %.3f s\n" %
+                         (self.name, self.nbytes, self.syscalls, self.stalls,
+                          self.peak, self.blocked))
+
+
+def open_sink(spec, maxbuf=maxbuf):
+    """
+    Create a Sink from an output specification: 'fifo:PATH', 'file:PATH',
+    'tcp:HOST:PORT' or 'stdout'.
+    """
+    if spec in ('-', 'stdout'):
+        # do not change the flags of a descriptor we share with our parent
+        return Sink('stdout', sys.stdout.fileno(), maxbuf, blocking=True)
+    kind, _, target = spec.partition(':')
+    if kind == 'fifo':
+        if not os.path.exists(target) or \
+                not stat.S_ISFIFO(os.stat(target).st_mode):
+            raise ValueError('%s is not a named pipe' % target)
+        # opening blocks until the reader, e.g. seedlink, is there
+        return Sink(spec, os.open(target, os.O_WRONLY), maxbuf)
+    if kind == 'file':
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        return Sink(spec, fd, maxbuf)
+    if kind == 'tcp':
+        host, _, port = target.rpartition(':')
+        sock = socket.create_connection((host, int(port)))
+        return Sink(spec, sock.fileno(), maxbuf, handle=sock)
+    raise ValueError('unknown output %s' % spec)
+
+
+class Output(object):
+    """
+    Fan the same data out to several sinks.
+
+    Writes never block as long as every sink has room in its buffer. If a
+    sink's buffer is full the playback waits for it (backpressure) and the
+    time is accounted to that sink. sleep() keeps the sinks going while
+    rt_simul waits for the next record to become due.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def syscalls(self):
+        return sum(sink.syscalls for sink in self.sinks)
+
+    def stalls(self):
+        return sum(sink.stalls for sink in self.sinks)
+
+    def absorbed(self):
+        """
+        Number of bytes taken by the slowest consumer.
+        """
+        return min(sink.nbytes for sink in self.sinks)
+
+    def write(self, data):
+        for sink in self.sinks:
+            sink.push(data)
+            sink.pump()
+        full = [sink for sink in self.sinks if sink.pending() > sink.maxbuf]
+        if full:
+            t = monotonic()
+            self._wait(lambda: any(sink.pending() > sink.maxbuf
+                                   for sink in full))
+            for sink in full:
+                sink.blocked += monotonic() - t
+
+    def sleep(self, seconds):
+        end = monotonic() + seconds
+        self._wait(lambda: monotonic() < end, end)
+
+    def close(self):
+        self._wait(lambda: any(sink.pending() for sink in self.sinks))
+
+    def _wait(self, condition, end=None):
+        while condition():
+            busy = [sink.fd for sink in self.sinks if sink.pending()]
+            timeout = None
+            if end is not None:
+                timeout = max(0., end - monotonic())
+            if busy:
+                select.select([], busy, [], timeout)
+            elif timeout is not None:
+                time.sleep(timeout)
+            else:
+                return
+            for sink in self.sinks:
+                sink.pump()
+
+    def report(self):
+        for sink in self.sinks:
+            sink.report()
+
+
+class BatchWriter(object):
+    """
+    Coalesce records into as few write system calls as possible.
+
+    Records are collected in memory until either *batch* records have been
+    buffered or flush() is called. rt_simul calls flush() before it goes to
+    sleep, so all records that are due at the same wakeup are handed to the
+    Output *output* at once.
+
+    If a record is written together with its deadline on the monotonic clock
+    the difference to the time the write completed is added to *stats*.
+    """
+
+    def __init__(self, output, batch=128, stats=None):
+        self.output = output
+        self.batch = max(1, batch)
+        self.stats = stats
+        self.buf = bytearray()
+        self.pending = 0
+        self.deadlines = []
+        self.records = 0
+        self.nbytes = 0
+        self.tstart = monotonic()
+
+    def write(self, data, deadline=None):
+        self.buf += data
+        self.pending += 1
+        if deadline is not None:
+            self.deadlines.append(deadline)
+        if self.pending >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        data = self.buf
+        self.records += self.pending
+        self.buf = bytearray()
+        self.pending = 0
+        self.output.write(data)
+        self.nbytes += len(data)
+        if self.stats is not None:
+            sent = monotonic()
+            for deadline in self.deadlines:
+                self.stats.add(deadline - sent)
+        self.deadlines = []
+
+    def report(self):
+        dt = max(monotonic() - self.tstart, 1e-6)
+        syscalls = self.output.syscalls()
+        sys.stderr.write("Sent %d records (%d bytes) in %d writes: "
+                         "%.1f records/s, %.1f syscalls/s\n" %
+                         (self.records, self.nbytes, syscalls,
+                          self.records / dt, syscalls / dt))
+        self.output.report()
+
+
+def read_input(f, jump=0, delaydict=None, window=None, recsize=legalrecsize):
+    """
+    Iterator over (time, record) tuples in the order in which the records
+    have to be sent, after skipping the first *jump* minutes.
+
+    *f* is either a file object, e.g. standard input, or an
+    msrecord.MSeedFile which is read through a memory map. For the latter
+    the records to jump over are looked up in the record index. Several
+    files are merged on the fly by passing an msrecord.MergedFiles. The
+    time is the record end time, or the delayed end time if *delaydict* is
+    given (see read_mseed_with_delays, which also takes *window*). Records
+    that are not *recsize* bytes long are split into records of that size
+    on the fly (see msrecord.reblock_records), each sent at its own end
+    time; *window* also bounds how long records are held back for that.
+    """
     etime = None
     skipping = True
-    record_iterable = mseed.Input(f)
+    if isinstance(f, msrecord.MSeedFile):
+        offset = 0
+        if jump:
+            # look up where to start instead of reading all skipped records
+            index = msrecord.RecordIndex.open(f.filename)
+            pos = index.skip(jump * 60)
+            offset = index.offset[pos] if pos < len(index) else f.size
+            jump = 0
+        record_iterable = f.records(offset)
+    elif isinstance(f, msrecord.MergedFiles):
+        record_iterable = iter(f)
+    else:
+        record_iterable = msrecord.read_records(f)
+    record_iterable = msrecord.reblock_records(record_iterable, recsize,
+                                               window)
     if delaydict:
-        record_iterable = read_mseed_with_delays(delaydict, record_iterable)
+        source = f if isinstance(f, msrecord.MSeedFile) else None
+        record_iterable = read_mseed_with_delays(delaydict, record_iterable,
+                                                 window, source)
     for rec in record_iterable:
         rec_time = None
         if delaydict:
             rec_time = rec[0]
             rec = rec[1]
         else:
-            rec_time = calendar.timegm(rec.end_time.timetuple())
+            rec_time = rec.end
         if etime is None:
             etime = rec_time
 
         if skipping:
             if (rec_time - etime) / 60 < jump:
                 continue
+            skipping = False
+        yield rec_time, rec
+
+
+def rt_simul(f, speed=1., jump=0, delaydict=None, idle=None, window=None,
+             sleep=time.sleep):
+    """
+    Iterator to simulate "real-time" MSeed input
 
+    At startup, the first MSeed record is read. The following records are
+    read in pseudo-real-time relative to the time of the first record,
+    resulting in data flowing at realistic speed. This is useful e.g. for
+    demonstrating real-time processing using real data of past events.
+
+    The data in the input file may be multiplexed, but *must* be sorted by
+    time, e.g. using 'mssort'. See read_input for the supported inputs.
+
+    Every record gets a deadline on the monotonic clock, relative to the
+    first record that is not skipped, and the iterator yields
+    (deadline, record) tuples. No record is released before its deadline:
+    the iterator sleeps until the deadline of the next record and then
+    releases it together with all records that are due by then. If given,
+    *idle* is called every time before the iterator goes to sleep, e.g. to
+    flush records that have been buffered for writing.
+    *window* is the maximum delay passed on to read_mseed_with_delays and
+    *sleep* the function used to wait, e.g. Output.sleep.
+    """
+    rtime = None
+    etime = None
+    for rec_time, rec in read_input(f, jump, delaydict, window):
+        if etime is None:
             etime = rec_time
-            skipping = False
+            rtime = monotonic()
+
+        deadline = rtime + (rec_time - etime) / speed
+        if deadline > monotonic():
+            if idle is not None:
+                idle()
+            while True:
+                wait = deadline - monotonic()
+                if wait <= 0:
+                    break
+                sleep(wait)
+        yield deadline, rec
 
-        tmax = etime + speed * (time.time() - rtime)
-        last_sample_time = rec.begin_time + datetime.timedelta(microseconds=1000000.0 * (rec.nsamp / rec.fsamp))
-        last_sample_time = calendar.timegm(last_sample_time.timetuple())
-        if last_sample_time > tmax:
-            time.sleep((last_sample_time - tmax + 0.001) / speed)
-        yield rec
+
+class RateControl(object):
+    """
+    Find the rate at which the consumers take the data.
+
+    Every *interval* seconds the number of records the slowest sink of
+    *output* actually wrote is compared to what was sent. If a consumer was
+    not ready to read (a stall) the send rate is set back to the rate that
+    was absorbed, otherwise it is increased by *step*.
+    """
+
+    def __init__(self, output, rate=1000., interval=0.5, step=1.25,
+                 recsize=legalrecsize):
+        self.output = output
+        self.rate = rate
+        self.interval = interval
+        self.step = step
+        self.recsize = recsize
+        self.tstart = self.t = monotonic()
+        self.absorbed = output.absorbed()
+        self.stalls = output.stalls()
+        self.peak = 0.
+
+    def update(self, now):
+        dt = now - self.t
+        if dt < self.interval:
+            return
+        absorbed = self.output.absorbed()
+        stalls = self.output.stalls()
+        rate = (absorbed - self.absorbed) / float(self.recsize) / dt
+        self.peak = max(self.peak, rate)
+        if stalls > self.stalls:
+            self.rate = max(rate, 1.)
+        else:
+            self.rate *= self.step
+        self.t, self.absorbed, self.stalls = now, absorbed, stalls
+
+    def report(self):
+        dt = max(monotonic() - self.tstart, 1e-6)
+        absorbed = self.output.absorbed() / float(self.recsize)
+        # the peak is only sampled every interval, a short run has none
+        peak = max(self.peak, absorbed / dt)
+        sys.stderr.write("Downstream absorbed at most %.1f records/s "
+                         "(%.1f records/s on average), last send rate "
+                         "%.1f records/s\n" %
+                         (peak, absorbed / dt, self.rate))
+
+
+def afap_simul(f, control, jump=0, delaydict=None, tick=0., idle=None,
+               window=None, sleep=time.sleep):
+    """
+    Iterator to send MSeed input as fast as the consumers can take it.
+
+    Records are sent in the same order as by rt_simul but paced by the
+    RateControl *control* instead of by their time stamps, so the data does
+    not pile up in the output buffers while the send rate is kept close to
+    what downstream absorbs. Records that are due within *tick* seconds
+    are released in the same wakeup instead of sleeping for each of them
+    separately. The other arguments are the same as for rt_simul.
+    """
+    deadline = None
+    for rec_time, rec in read_input(f, jump, delaydict, window):
+        now = monotonic()
+        control.update(now)
+        if deadline is None or deadline < now - control.interval:
+            # do not try to catch up after having been blocked
+            deadline = now
+        else:
+            deadline += 1. / control.rate
+        if deadline > now + tick:
+            if idle is not None:
+                idle()
+            while True:
+                wait = deadline - monotonic()
+                if wait <= 0:
+                    break
+                sleep(wait)
+        yield deadline, rec
 
 
 usage_info = """
 msrtsimul - read sorted (and possibly multiplexed) MiniSEED files and
         write the individual records in pseudo-real-time. This is useful
         e.g. for testing and simulating data acquisition. Output
-        is $SEISCOMP_ROOT/var/run/seedlink/mseedfifo unless -c is used.
+        is $SEISCOMP_ROOT/var/run/seedlink/mseedfifo unless -c or -o is
+        used.
+        If several files or directories are given their records are
+        merged in time order and duplicates are dropped. Records that
+        are not 512 bytes long are split into 512-byte records on the fly.
 
-Usage: msrtsimul.py [options] [file]
+Usage: msrtsimul.py [options] [file|directory ...]
 
 Options:
     -c, --stdout        write on standard output
+    -o, --output        write to 'fifo:PATH', 'file:PATH', 'tcp:HOST:PORT'
+                        or 'stdout'; may be given several times to feed
+                        several consumers at once
+        --buffer        output buffer per consumer in bytes (default: 4 MB)
     -d, --delays        add artificial delays
     -s, --speed         speed factor
+        --afap          send as fast as the consumers take the data and
+                        report the rate they absorbed (ignores -s)
     -j, --jump          number of minutes to skip
         --test          test mode
     -m  --mode          choose between 'realtime' and 'historic'
     -v, --verbose       verbose mode
     -h, --help          display this help message
     -t, --starttime     define at which time the first record should be sent
+        --tick          with --afap, scheduling tick in seconds; records due
+                        within the same tick are written together (default:
+                        0.01). Otherwise records are never written before
+                        they are due.
+        --batch         maximum number of records per write (default: 128)
+        --stats         write playback statistics to this file every
+                        --stats-interval seconds, as JSON lines or in the
+                        Prometheus text format if the name ends with .prom
+        --stats-interval
+                        seconds between statistics updates (default: 10)
+        --window        maximum station delay in seconds; bounds the number
+                        of records held back for reordering, also to send
+                        the pieces of split records in time (default: 600)
 """
 
 def usage(exitcode=0):
@@ -128,17 +753,19 @@ def usage(exitcode=0):
     sys.exit(exitcode)
 
 try:
-    opts, args = getopt(sys.argv[1:], "cd:s:j:hvm:t:",
+    opts, args = getopt(sys.argv[1:], "cd:s:j:hvm:t:o:",
                         [ "stdout", "delays=", "speed=", "jump=", "test", "verbose", "help", "mode=",
-"starttime=" ])
+"starttime=", "tick=", "batch=", "window=", "output=", "buffer=", "afap", "stats=",
+"stats-interval=" ])
 except GetoptError:
     usage(exitcode=1)
 
-out_channel = None
+outputs = []
 delays = None
 
 for flag, arg in opts:
-    if   flag in ("-c", "--stdout"):    out_channel = sys.stdout
+    if   flag in ("-c", "--stdout"):    outputs.append("stdout")
+    elif flag in ("-o", "--output"):    outputs.append(arg)
     elif flag in ("-d", "--delays"):     delays = arg
     elif flag in ("-s", "--speed"):     speed = float(arg)
     elif flag in ("-j", "--jump"):      jump = int(arg)
@@ -146,18 +773,27 @@ for flag, arg in opts:
     elif flag in ("-m", "--mode"):      mode = arg
     elif flag in ("-v", "--verbose"):   verbosity += 1
     elif flag in ("-t", "--starttime"): starttime = datetime.datetime.strptime(arg, "%Y-%m-%d %H:%M:%S.%f")
+    elif flag in ("--tick"):            tick = float(arg)
+    elif flag in ("--batch"):           batch = int(arg)
+    elif flag in ("--window"):          window = float(arg)
+    elif flag in ("--buffer"):          maxbuf = int(arg)
+    elif flag in ("--afap"):            afap = True
+    elif flag in ("--stats"):           statsfile = arg
+    elif flag in ("--stats-interval"):  statsinterval = float(arg)
     elif flag in ("--test"):            test = True
     else: usage(exitcode=1)
 
 if len(args) == 0:
     pass
-elif len(args) == 1:
+elif len(args) == 1 and not os.path.isdir(args[0]):
     fname = args[0]
     if fname != "-":
-        ifile = file(fname)
+        ifile = msrecord.MSeedFile(fname)
+elif "-" not in args:
+    ifile = msrecord.MergedFiles(args)
 else: usage(exitcode=1)
 
-if out_channel is None:
+if not outputs:
     try: sc_root = os.environ["SEISCOMP_ROOT"]
     except:
         sys.stderr.write("SEISCOMP_ROOT environment variable is not set\n")
@@ -178,10 +814,12 @@ Check if SeedLink is running and configured for real-time playback.
 """ % mseed_fifo)
         sys.exit(1)
 
-    try: out_channel = open(mseed_fifo, "w")
-    except Exception, e:
-        sys.stderr.write("%s\n" % str(e))
-        sys.exit(1)
+    outputs.append("fifo:%s" % mseed_fifo)
+
+try: output = Output([open_sink(spec, maxbuf) for spec in outputs])
+except Exception, e:
+    sys.stderr.write("%s\n" % str(e))
+    sys.exit(1)
 
 try:
     stime = time.time()
@@ -197,7 +835,23 @@ try:
                 delaydict[content[0].strip()] = float(content[1].strip())
         except: pass
 
-    input = rt_simul(ifile, speed=speed, jump=jump, delaydict=delaydict)
+    pacing = SendTimeStats()
+    writer = BatchWriter(output, batch=batch, stats=pacing)
+    sleep = output.sleep
+    telemetry = None
+    if statsfile:
+        telemetry = Telemetry(statsfile, statsinterval, pacing, delaydict,
+                              window)
+        sleep = telemetry.sleeper(sleep)
+    control = None
+    if afap:
+        control = RateControl(output)
+        input = afap_simul(ifile, control, jump=jump, delaydict=delaydict,
+                           tick=tick, idle=writer.flush, window=window,
+                           sleep=sleep)
+    else:
+        input = rt_simul(ifile, speed=speed, jump=jump, delaydict=delaydict,
+                         idle=writer.flush, window=window, sleep=sleep)
 
     # input = rt_simul(ifile, speed=speed, jump=jump)
     time_diff = None
@@ -205,28 +859,51 @@ try:
         while datetime.datetime.utcnow() < starttime:
             time.sleep(0.01)
     sys.stderr.write("Starting msrtsimul at %s\n" % datetime.datetime.utcnow())
-    for rec in input:
+    for deadline, rec in input:
         if rec.size != legalrecsize:
-            sys.stderr.write("Illegal rec.size : %s_%s %7.2f %s %7.2f\n" % (rec.net, rec.sta, (time.time() - stime), str(rec.begin_time),
-                                                         time.time() - calendar.timegm(rec.begin_time.timetuple())))
+            sys.stderr.write("Illegal rec.size : %s_%s %7.2f %s %7.2f\n" % (rec.net, rec.sta, (time.time() - stime), datetime.datetime.utcfromtimestamp(rec.begin),
+                                                         time.time() - rec.begin))
+            if telemetry is not None:
+                telemetry.dropped(rec)
             continue
         if time_diff is None:
-            time_diff = datetime.datetime.utcnow() - rec.begin_time - \
-                datetime.timedelta(microseconds=1000000.0 * (rec.nsamp / rec.fsamp))
+            time_diff = time.time() - rec.end
         if mode == 'realtime':
-            rec.begin_time += time_diff
+            # only the BTIME field of the fixed header is rewritten, the
+            # record itself is forwarded as is
+            if not isinstance(rec.data, bytearray):
+                rec = rec.copy()
+            rec.shift(time_diff)
 
         if verbosity:
-            sys.stderr.write("%s_%s %7.2f %s %7.2f\n" % (rec.net, rec.sta, (time.time() - stime), str(rec.begin_time),
-                                                         time.time() - calendar.timegm(rec.begin_time.timetuple())))
+            sys.stderr.write("%s_%s %7.2f %s %7.2f\n" % (rec.net, rec.sta, (time.time() - stime), datetime.datetime.utcfromtimestamp(rec.begin),
+                                                         time.time() - rec.begin))
             # sys.stderr.write("%s_%s %7.2f %s\n" % (rec.net, rec.sta, (time.time()-stime), str(rec.begin_time)))
 
         if not test:
-            rec.write(out_channel,9)
-            out_channel.flush()
+            writer.write(rec.raw(), deadline)
+        else:
+            pacing.add(deadline - monotonic())
+        if telemetry is not None:
+            telemetry.sent(rec)
+
+    writer.flush()
+    output.close()
+    writer.report()
+    pacing.report()
+    if control is not None:
+        control.report()
+    if isinstance(ifile, msrecord.MergedFiles):
+        sys.stderr.write("Dropped %d duplicate records\n" % ifile.duplicates)
+    if telemetry is not None:
+        telemetry.dump()
 
 except KeyboardInterrupt:
-    pass
+    writer.flush()
+    writer.report()
+    pacing.report()
+    if telemetry is not None:
+        telemetry.dump()
 except Exception, e:
     sys.stderr.write("Exception:  %s\n" % str(e))
     sys.exit(1)
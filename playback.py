@@ -13,19 +13,29 @@ import glob
 import imp
 import os
 import pipes
+import Queue
 import shutil
 import signal
+import socket
+import sqlite3
 import subprocess as sp
 import subprocess
 import shutil
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import uuid
 from seiscomp3 import Config, System
 import seiscomp3.Kernel
-import seiscomp3.IO
+import msrecord
+
+
+# default port of the spread daemon used by the messaging system
+SPREAD_PORT = 4803
+# default port of seedlink, where the modules get their waveforms from
+SEEDLINK_PORT = 18000
 
 
 class PBError(Exception):
@@ -40,15 +50,191 @@ def error(msg):
 def start_module(mod, params=''):
     """
     Monkey patch the start parameter routine to pass in additional command line
-    arguments.
+    arguments. The parameters are always added to those of the original
+    routine, so a module can be started several times.
     """
     touch(env.runFile(mod.name))
-    old_params = mod._get_start_params()
+    if not hasattr(mod, '_pb_orig_params'):
+        mod._pb_orig_params = mod._get_start_params
+    old_params = mod._pb_orig_params()
     new_params = lambda: old_params + ' ' + params
     mod._get_start_params = new_params
     return mod.start()
 
 
+def wait_until(ready, deadline, interval=0.1):
+    """
+    Poll *ready* until it returns True or until time.time() passes
+    *deadline*. Returns the last result of *ready*.
+    """
+    while not ready():
+        if time.time() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def port_open(port, host='localhost'):
+    """
+    Check whether a server accepts TCP connections on *port*.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(1)
+    try:
+        s.connect((host, port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
+def fifo_ready(fifofn):
+    """
+    Check whether the fifo has a reader, i.e. whether seedlink has opened it.
+    Opening a fifo for writing without blocking fails if there is no reader.
+    """
+    try:
+        fd = os.open(fifofn, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    os.close(fd)
+    return True
+
+
+def module_pid(mod):
+    try:
+        f = open(env.lockFile(mod.name))
+        try:
+            return int(f.read().split()[0])
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def _established_sockets(port=None):
+    inodes = set()
+    for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            f = open(table)
+        except IOError:
+            continue
+        try:
+            f.readline()
+            for line in f:
+                fields = line.split()
+                # state 01 is TCP_ESTABLISHED
+                if len(fields) < 10 or fields[3] != '01':
+                    continue
+                # the remote address is HEXIP:HEXPORT
+                if port is None or int(fields[2].split(':')[1], 16) == port:
+                    inodes.add(fields[9])
+        finally:
+            f.close()
+    return inodes
+
+
+def connected(pid, port=None):
+    """
+    Check whether process *pid* holds an established TCP connection, e.g. to
+    the messaging system or to seedlink. With *port* only connections to
+    that port count.
+    """
+    fddir = '/proc/%d/fd' % pid
+    try:
+        fds = os.listdir(fddir)
+    except OSError:
+        return False
+    inodes = _established_sockets(port)
+    for fd in fds:
+        try:
+            link = os.readlink(os.path.join(fddir, fd))
+        except OSError:
+            continue
+        if link.startswith('socket:[') and link[8:-1] in inodes:
+            return True
+    return False
+
+
+def wait_for_modules(mods, deadline, port=None):
+    """
+    Wait until every module in the dictionary *mods* is connected, to *port*
+    if given. Modules that are not ready by *deadline* are reported and
+    otherwise ignored.
+    """
+    pending = dict(mods)
+
+    def ready():
+        for name in pending.keys():
+            pid = module_pid(pending[name])
+            if pid is not None and connected(pid, port):
+                print "%s is ready" % name
+                del pending[name]
+        return not pending
+
+    if not wait_until(ready, deadline, 0.2):
+        for name in sorted(pending):
+            pid = module_pid(pending[name])
+            if pid is None or not os.path.isdir('/proc/%d' % pid):
+                error('%s is not running' % name)
+            else:
+                error('%s is not connected yet, continuing anyway' % name)
+
+
+def set_fake_clock(fn, t, rate=None, start=None):
+    """
+    Write the libfaketime offset that makes the clock show the UTC datetime
+    *t* now. Running processes pick up the new offset from the file.
+
+    With *rate* the clock runs *rate* times faster than real time. As
+    libfaketime accelerates the clock from a start time, *start* has to be
+    the start time shared by all processes (see share_fake_clock()).
+    """
+    now = time.time()
+    t = calendar.timegm(t.utctimetuple()) + t.microsecond * 1e-6
+    if rate is None:
+        spec = '%+f' % (t - now)
+    else:
+        # libfaketime shows start + rate * (now - start) + offset
+        spec = '%+f x%s' % (t - start - rate * (now - start), rate)
+    tmp = fn + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        f.write('%s\n' % spec)
+    finally:
+        f.close()
+    os.rename(tmp, fn)
+
+
+def share_fake_clock():
+    """
+    Set up a start time for libfaketime that is shared by all processes.
+    Otherwise every process would accelerate its clock from the time it was
+    started itself and the clocks would drift apart.
+
+    The faketime wrapper creates the shared memory for its children and
+    removes it when they are gone, so a child is kept waiting on its
+    standard input. Returns the wrapper process (close its standard input to
+    release the memory), the value for FAKETIME_SHARED and the start time.
+    """
+    before = time.time()
+    try:
+        proc = sp.Popen(['faketime', '+0', 'sh', '-c',
+                         'echo "$FAKETIME_SHARED"; exec cat'],
+                        stdin=sp.PIPE, stdout=sp.PIPE)
+    except OSError, e:
+        raise PBError('Cannot run faketime: %s' % e)
+    shared = proc.stdout.readline().strip()
+    # the start time is set when libfaketime is loaded by the child
+    start = (before + time.time()) / 2
+    if not shared:
+        proc.stdin.close()
+        proc.wait()
+        raise PBError('faketime does not support shared start times')
+    return proc, shared, start
+
+
 ##### The following functions were copied from the seiscomp startup script ####
 def touch(filename):
     try:
@@ -57,8 +243,10 @@ def touch(filename):
         PBError(str(exc))
 
 
-def system(args):
-    proc = sp.Popen(args, shell=False, env=os.environ)
+def system(args, env=None):
+    if env is None:
+        env = os.environ
+    proc = sp.Popen(args, shell=False, env=env)
     while True:
         try:
             return proc.wait()
@@ -189,9 +377,9 @@ def setup_config(configdir, db):
     # scmaster's database connection can't be set on the command line so we
     # have to generate a temporary config file that sets the database
     # connection
-    # tmp_config = tempfile.NamedTemporaryFile()
-    # tmp_config.close()
-    tmp_config = '/tmp/scmaster_tmp.cfg'
+    # the file name is unique so that several playbacks can run at once
+    fd, tmp_config = tempfile.mkstemp(prefix='scmaster_', suffix='.cfg')
+    os.close(fd)
     cfg_tmp = Config.Config()
     cfg = Config.Config()
     ei.initConfig(cfg, 'scmaster')
@@ -222,6 +410,67 @@ def setup_config(configdir, db):
     return tmp_config
 
 
+def append_config(fn, settings):
+    """
+    Append 'name = value' lines for the (name, value) pairs of *settings* to
+    the configuration file *fn*; later entries override earlier ones.
+    """
+    f = open(fn, 'a')
+    try:
+        f.write('\n# added for the playback sandbox\n')
+        for name, value in settings:
+            f.write('%s = %s\n' % (name, value))
+    finally:
+        f.close()
+
+
+def setup_sandbox(path, config_dir, database, port):
+    """
+    Create a sandbox in *path* for a playback that runs next to others on
+    the same machine. It consists of a SeisComP3 root with its own etc and
+    var directories that links to everything else of the installation, a
+    copy of *config_dir* as ~/.seiscomp3, a copy of *database* and its own
+    seedlink fifo. The messaging system uses *port* (spread also needs
+    port + 1) and seedlink port + 2.
+
+    Returns the database and the fifo of the sandbox and the environment to
+    run playback.py in it.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    root = os.path.join(path, 'seiscomp3')
+    home = os.path.join(path, 'home')
+    os.makedirs(root)
+    install = ei.installDir()
+    for name in os.listdir(install):
+        if name not in ('etc', 'var'):
+            os.symlink(os.path.join(install, name), os.path.join(root, name))
+    shutil.copytree(os.path.join(install, 'etc'), os.path.join(root, 'etc'),
+                    symlinks=True)
+    for d in (('var', 'run', 'seedlink'), ('var', 'lib', 'seedlink'),
+              ('var', 'log')):
+        os.makedirs(os.path.join(root, *d))
+    fifo = os.path.join(root, 'var', 'run', 'seedlink', 'mseedfifo')
+    os.mkfifo(fifo)
+
+    cfgdir = os.path.join(home, '.seiscomp3')
+    shutil.copytree(config_dir, cfgdir, symlinks=True,
+                    ignore=shutil.ignore_patterns('log', '.logbu'))
+    append_config(os.path.join(cfgdir, 'global.cfg'),
+                  [('connection.server', 'localhost:%d' % port),
+                   ('plugins.mseedfifo.fifo', fifo),
+                   ('recordstream', 'slink://localhost:%d' % (port + 2)),
+                   ('recordstream.service', 'slink'),
+                   ('recordstream.source', 'localhost:%d' % (port + 2))])
+    append_config(os.path.join(cfgdir, 'spread.cfg'), [('port', port)])
+    append_config(os.path.join(cfgdir, 'seedlink.cfg'), [('port', port + 2)])
+
+    db = os.path.join(path, os.path.basename(database))
+    shutil.copy(database, db)
+    environ = dict(os.environ, HOME=home, SEISCOMP_ROOT=root)
+    return db, fifo, environ
+
+
 def get_enabled_modules(exclude=[]):
     """
     Return a list of enabled modules in the order in which they would be
@@ -244,123 +493,424 @@ def get_enabled_modules(exclude=[]):
 
 def get_start_time(fn):
     """
-    Find the earliest end-time of all records in the waveform file.
+    Find the earliest end-time of all records in the waveform file or in
+    all waveform files of a directory.
     """
-    stream = seiscomp3.IO.RecordStream.Open('file://%s' % fn)
-    input = seiscomp3.IO.RecordInput(stream, seiscomp3.Core.Array.INT,
-                                     seiscomp3.Core.Record.SAVE_RAW)
-    tmin = datetime.datetime.utcnow()
-    while True:
+    tmin = msrecord.earliest_end_time([fn])
+    if tmin is None:
+        return datetime.datetime.utcnow()
+    return datetime.datetime.utcfromtimestamp(tmin)
+
+
+def msrtsimul_command(speed=None, jump=None, delays=None, mode='realtime'):
+    command = ["seiscomp", "exec", 
+    os.path.dirname(os.path.realpath(__file__))+"/msrtsimul.py"]
+    if speed is not None:
+        command += ["-s", speed]
+    if jump is not None:
+        command += ["-j", jump]
+    if delays is not None:
+        command += ["-d", delays]
+    if mode != 'realtime':
+        command += ['-m', 'historic']
+    return command
+
+
+def dispatch_command(eventfile, mode='realtime', port=SPREAD_PORT):
+    if not os.path.isfile(eventfile):
+        raise PBError('Eventxml %s does not exist' % eventfile)
+    dispatch_cmd = ['seiscomp', 'exec', 'scdispatch']
+    dispatch_cmd += ['-i', eventfile, '-O', 'add']
+    if port != SPREAD_PORT:
+        dispatch_cmd += ['-H', 'localhost:%d' % port]
+    # if we run in historic mode merge origins
+    if mode != 'realtime':
+        routingtable = 'Pick:PICK,Amplitude:AMPLITUDE,Origin:LOCATION,'
+        routingtable += 'Magnitude:MAGNITUDE,StationMagnitude:MAGNITUDE,'
+        routingtable += 'FocalMechanism:FOCMECH'
+        dispatch_cmd += ['--routingtable', routingtable]
+    return dispatch_cmd
+
+
+def start_modules(mods, database, scmaster_cfg, fifo, deadline,
+                  port=SPREAD_PORT):
+    """
+    Start the core modules and all modules in *mods* and wait until they
+    are ready, at most until *deadline*. Modules are started as soon as the
+    services they depend on accept connections.
+    """
+    mods = dict(mods)
+    start_module(mods.pop('kernel'))
+    start_module(mods.pop('spread'))
+    # seedlink comes up while waiting for the messaging system
+    start_module(mods.pop('seedlink'))
+    if not wait_until(lambda: port_open(port), deadline):
+        error('spread does not accept connections on port %d' % port)
+    scmaster = mods.pop('scmaster')
+    start_module(scmaster, '--start-stop-msg=1 --config %s' % scmaster_cfg)
+    wait_for_modules({'scmaster': scmaster}, deadline)
+    # all other modules only depend on the messaging system
+    for _n, _m in mods.iteritems():
+        start_module(_m, '-d "sqlite3://%s"' % database)
+        #start_module(_m,'--plugins dbsqlite3,evscore,dmvs,dmsm,locnll,mlh -d "sqlite3://%s"' % database)
+    # manual starts a module in debug interactive mode
+    #os.system("scfdalpine --trace --plugins dbsqlite3,dmvs,dmsm,mlh -d sqlite3://%s > /home/sysop/.seiscomp3/log/scfdalpine.log 2>&1 &" % database)
+    #os.system("scfdforela --trace --plugins dbsqlite3,dmvs,dmsm,mlh -d sqlite3://%s > /home/sysop/.seiscomp3/log/scfdforela.log 2>&1 &" % database)
+    #os.system('scfinder --trace --plugins dbsqlite3,dmvs,dmsm,mlh -d sqlite3://%s &> /home/sysop/.seiscomp3/log/scfinder.log &' % database)
+    #os.system('scm --plugins dbsqlite3,dmvs,dmsm,mlh -d "sqlite3://%s" &' % database)
+    #os.system('scmm --plugins dbsqlite3,dmvs,dmsm,mlh -d "sqlite3://%s" &' % database)
+    #os.system('scrttv --plugins dbsqlite3,dmvs,dmsm,mlh -d "sqlite3://%s" &' % database)
+    #os.system('scolv --plugins dbsqlite3,dmvs,dmsm,mlh -d "sqlite3://%s" &' % database)
+    if not wait_until(lambda: fifo_ready(fifo), deadline):
+        error('seedlink has not opened %s' % fifo)
+    wait_for_modules(mods, deadline)
+
+
+def stop_modules(mods, sandbox=False):
+    """
+    Stop all modules. In a sandbox only the modules of the sandbox are
+    stopped, otherwise this is 'seiscomp stop'.
+    """
+    if not sandbox:
+        system(['seiscomp', 'stop'])
+        return
+    for _m in sorted(mods.values(), cmp=module_compare, reverse=True):
+        try:
+            _m.stop()
+        except Exception, e:
+            error('%s: %s' % (_m.name, e))
+
+
+def seedlink_clients(mods, port):
+    """
+    Return the modules of *mods* that are connected to seedlink on *port*.
+    """
+    clients = {}
+    for name, mod in mods.iteritems():
+        pid = module_pid(mod)
+        if name != 'seedlink' and pid is not None and connected(pid, port):
+            clients[name] = mod
+    return clients
+
+
+def restart_seedlink(mods, fifo, deadline, port=SEEDLINK_PORT):
+    """
+    Restart seedlink with an empty buffer so that it accepts records that
+    are not newer than those of the previous playback. Waits until the
+    modules of *mods* that were connected to seedlink on *port* have
+    connected again.
+    """
+    clients = seedlink_clients(mods, port)
+    mods['seedlink'].stop()
+    setup_seedlink(fifo)
+    start_module(mods['seedlink'])
+    if not wait_until(lambda: fifo_ready(fifo), deadline):
+        error('seedlink has not opened %s' % fifo)
+    wait_for_modules(clients, deadline, port)
+
+
+def database_events(database):
+    """
+    Return the public IDs of all events in the sqlite3 *database*.
+    """
+    try:
+        conn = sqlite3.connect(database)
         try:
-            rec = input.next()
-        except:
-            break
-        if not rec:
-            break
-        te = rec.endTime().toString("%FT%T.%4fZ")
-        ts = rec.startTime().toString("%FT%T.%4fZ")
-        dts = datetime.datetime.strptime(ts, "%Y-%m-%dT%H:%M:%S.%fZ")
-        dte = datetime.datetime.strptime(te, "%Y-%m-%dT%H:%M:%S.%fZ")
-        if dte < tmin:
-            tmin = dte
-            Id = rec.streamID()
-    return tmin
+            return set(row[0] for row in conn.execute(
+                'SELECT PublicObject.publicID FROM Event, PublicObject '
+                'WHERE Event._oid = PublicObject._oid'))
+        finally:
+            conn.close()
+    except sqlite3.Error, e:
+        error('cannot read the events of %s: %s' % (database, e))
+        return set()
+
+
+def read_batch(fn):
+    """
+    Read a batch file with one playback per line: the waveform file or
+    directory and, separated by a tab, optionally an event file. Empty
+    lines and lines starting with '#' are ignored.
+    """
+    playbacks = []
+    f = open(fn)
+    try:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            wf = fields[0].strip()
+            eventfile = None
+            if len(fields) > 1 and fields[1].strip():
+                eventfile = fields[1].strip()
+            playbacks.append((wf, eventfile))
+    finally:
+        f.close()
+    return playbacks
 
 
 def run(wf, database, config_dir, fifo, speed=None, jump=None, delays=None,
-        mode='realtime', startupdelay=15, args='', eventfile=None):
+        mode='realtime', startupdelay=60, args='', eventfile=None,
+        sandbox=False, port=SPREAD_PORT):
     """
     Start SeisComP3 modules and the waveform playback.
+
+    Modules are started as soon as the services they depend on accept
+    connections and the playback begins once all of them are connected,
+    waiting at most *startupdelay* seconds.
+    """
+    run_batch([(wf, eventfile)], database, config_dir, fifo, speed=speed,
+              jump=jump, delays=delays, mode=mode, startupdelay=startupdelay,
+              sandbox=sandbox, port=port)
+
+
+def run_batch(playbacks, database, config_dir, fifo, speed=None, jump=None,
+              delays=None, mode='realtime', startupdelay=60, windows=None,
+              sandbox=False, port=SPREAD_PORT):
     """
-    if not os.path.isfile(wf):
-        raise PBError('Data %s does not exist.' % wf)
+    Start SeisComP3 modules once and play back the (waveforms, eventfile)
+    pairs of *playbacks* one after another.
+
+    Between two playbacks only seedlink is restarted with an empty buffer
+    and, in historic mode, the simulated clock is set to the first record
+    of the next playback. Historic playbacks are run in time order. If the
+    next playback starts before the current time of the simulated clock,
+    e.g. for overlapping event windows, all modules are restarted instead,
+    so the clock never goes backwards while modules hold newer data.
+
+    All results are written to *database*. For every playback a line with
+    the waveforms, its time span and the IDs of the events that appeared in
+    the database during the playback is appended to the file *windows*.
+
+    With *sandbox* the playback runs in a sandbox created by
+    setup_sandbox() with the messaging system on *port* and leaves all
+    other SeisComP3 processes alone.
+    """
+    for wf, eventfile in playbacks:
+        if not os.path.exists(wf):
+            raise PBError('Data %s does not exist.' % wf)
+        if eventfile is not None and not os.path.isfile(eventfile):
+            raise PBError('Eventxml %s does not exist' % eventfile)
     if not os.path.isdir(config_dir):
         raise PBError('Config %s does not exist.' % config_dir)
-    system(['seiscomp', 'stop'])
-#    tmpfile = "/tmp/%s" % uuid.uuid4()
-#    print("/usr/local/bin/qmerge -b 512 -o %s %s" %(tmpfile,wf))
-#    subprocess.call(["/usr/local/bin/qmerge", "-b", "512", "-o",tmpfile,wf])
-#    shutil.copyfile(tmpfile,wf)
-#    os.remove(tmpfile)
+    if not sandbox:
+        system(['seiscomp', 'stop'])
 
-    scmaster_cfg = setup_config(config_dir, database)
     setup_seedlink(fifo)
 
     # construct msrtsimul command
-    command = ["seiscomp", "exec", 
-    os.path.dirname(os.path.realpath(__file__))+"/msrtsimul.py"]
-    if speed is not None:
-        command += ["-s", speed]
-    if jump is not None:
-        command += ["-j", jump]
-    if delays is not None:
-        command += ["-d", delays]
-
-    # Construct scdispatch command
-    if eventfile is not None:
-        if not os.path.isfile(eventfile):
-            raise PBError('Eventxml %s does not exist' % eventfile)
-        dispatch_cmd = ['seiscomp', 'exec', 'scdispatch']
-        dispatch_cmd += ['-i', eventfile, '-O', 'add']
-        # if we run in historic mode merge origins
-        if mode != 'realtime':
-            routingtable = 'Pick:PICK,Amplitude:AMPLITUDE,Origin:LOCATION,'
-            routingtable += 'Magnitude:MAGNITUDE,StationMagnitude:MAGNITUDE,'
-            routingtable += 'FocalMechanism:FOCMECH'
-            dispatch_cmd += ['--routingtable', routingtable]
+    command = msrtsimul_command(speed, jump, delays, mode)
+    command += ['-o', 'fifo:%s' % fifo]
 
     # start SC3 modules
     mods = get_enabled_modules()
-    processes = []
+    seedlink = mods['seedlink']
+    rate = None
+    if mode != 'realtime' and speed is not None and float(speed) != 1:
+        rate = float(speed)
+    if sandbox:
+        # generate the spread and seedlink configurations with the ports of
+        # the sandbox
+        mods['spread'].updateConfig()
+        seedlink.updateConfig()
+    seedlink_port = SEEDLINK_PORT
+    if sandbox:
+        seedlink_port = port + 2
+    clock = None
+    faketime = start = fake = None
+    dispatch_cmd = None
+    # msrtsimul paces the records itself, so it runs on the real clock
+    real_env = os.environ.copy()
+    scmaster_cfg = setup_config(config_dir, database)
     try:
         if mode != 'realtime':
-            command += ['-m', 'historic']
-            t0 = get_start_time(wf)
-            command += ['-t', str(t0)]
-            t0 -= datetime.timedelta(seconds=startupdelay)
+            playbacks = sorted((get_start_time(wf), wf, eventfile)
+                               for wf, eventfile in playbacks)
+            t0 = playbacks[0][0]
             print "Start time %s" % t0
             # /usr/lib/faketime/libfaketime.so.1'
             os.environ[
                 'LD_PRELOAD'] = '/usr/lib/x86_64-linux-gnu/faketime/libfaketime.so.1'
-            ts = time.time()
-            # Set system time in seconds relative to UTC now
-            os.environ['FAKETIME'] = "%f" % (
-                calendar.timegm(t0.utctimetuple()) - ts)
+            # The modules start up with a clock that is startupdelay seconds
+            # behind the first record. Once all of them are ready the clock
+            # is moved forward to the first record through the timestamp
+            # file so the playback begins without further delay.
+            fd, clock = tempfile.mkstemp(prefix='playback-faketime-')
+            os.close(fd)
+            set_fake_clock(clock, t0 - datetime.timedelta(seconds=startupdelay))
+            # the simulated clock showed fake[0] at the real time fake[1]
+            # and runs at the rate fake[2]
+            fake = (t0 - datetime.timedelta(seconds=startupdelay), time.time(),
+                    None)
+            os.environ['FAKETIME_TIMESTAMP_FILE'] = clock
+            os.environ['FAKETIME_CACHE_DURATION'] = '1'
+            os.environ.pop('FAKETIME', None)
+            if rate is not None:
+                # the clock of the modules runs as fast as msrtsimul sends
+                # the records
+                faketime, shared, start = share_fake_clock()
+                os.environ['FAKETIME_SHARED'] = shared
         else:
+            playbacks = [(None, wf, eventfile) for wf, eventfile in playbacks]
+        deadline = time.time() + startupdelay
+        start_modules(mods, database, scmaster_cfg, fifo, deadline, port)
+        print "Startup took %.1f s" % (time.time() - deadline + startupdelay)
+
+        known = database_events(database)
+        done = None
+        for n, (t0, wf, eventfile) in enumerate(playbacks):
+            cold = False
+            if clock is not None:
+                # all processes re-read the timestamp file within the cache
+                # duration; the clock reaches t0 when msrtsimul starts
+                wait = float(os.environ['FAKETIME_CACHE_DURATION'])
+                t = t0 - datetime.timedelta(seconds=wait * (rate or 1))
+                ft, fts, frate = fake
+                cold = n and t < ft + datetime.timedelta(
+                    seconds=(time.time() - fts) * (frate or 1))
+            if done is not None:
+                known = attribute(done, windows, database, known)
+            if cold:
+                # the modules have already seen later data
+                print "%s overlaps the previous playback, restarting" % wf
+                stop_modules(mods, sandbox)
+                setup_seedlink(fifo)
+                set_fake_clock(clock,
+                               t0 - datetime.timedelta(seconds=startupdelay))
+                fake = (t0 - datetime.timedelta(seconds=startupdelay),
+                        time.time(), None)
+                deadline = time.time() + startupdelay
+                start_modules(mods, database, scmaster_cfg, fifo, deadline,
+                              port)
+            elif n:
+                restart_seedlink(mods, fifo, time.time() + startupdelay,
+                                 seedlink_port)
+            cmd = list(command)
+            if clock is not None:
+                set_fake_clock(clock, t, rate, start)
+                fake = (t, time.time(), rate)
+                time.sleep(wait)
+            else:
+                t0 = datetime.datetime.utcnow()
+            dispatch_cmd = None
+            if eventfile is not None:
+                dispatch_cmd = dispatch_command(eventfile, mode, port)
             ts = time.time()
-            startupdelay = 0
-        start_module(mods.pop('kernel'))
-        start_module(mods.pop('spread'))
-        start_module(mods.pop('seedlink'))
-        start_module(mods.pop('scmaster'), '--start-stop-msg=1 --config %s' % scmaster_cfg)
-        for _n, _m in mods.iteritems():
-		start_module(mods[_n],'-d "sqlite3://%s"' % database)
-		#start_module(mods[_n],'--plugins dbsqlite3,evscore,dmvs,dmsm,locnll,mlh -d "sqlite3://%s"' % database)
-	# manual starts a module in debug interactive mode
-	#os.system("scfdalpine --trace --plugins dbsqlite3,dmvs,dmsm,mlh -d sqlite3://%s > /home/sysop/.seiscomp3/log/scfdalpine.log 2>&1 &" % database)
-	#os.system("scfdforela --trace --plugins dbsqlite3,dmvs,dmsm,mlh -d sqlite3://%s > /home/sysop/.seiscomp3/log/scfdforela.log 2>&1 &" % database)
-	#os.system('scfinder --trace --plugins dbsqlite3,dmvs,dmsm,mlh -d sqlite3://%s &> /home/sysop/.seiscomp3/log/scfinder.log &' % database)
-	#os.system('scm --plugins dbsqlite3,dmvs,dmsm,mlh -d "sqlite3://%s" &' % database)
-	#os.system('scmm --plugins dbsqlite3,dmvs,dmsm,mlh -d "sqlite3://%s" &' % database)
-        #os.system('scrttv --plugins dbsqlite3,dmvs,dmsm,mlh -d "sqlite3://%s" &' % database)
-        #os.system('scolv --plugins dbsqlite3,dmvs,dmsm,mlh -d "sqlite3://%s" &' % database)
-
-        command.append(wf)
-
-        #print('Executing: %s', command)
-        system(command)
-        if eventfile is not None:
-            system(dispatch_cmd)
-        system(['seiscomp', 'stop'])
+            cmd.append(wf)
+
+            #print('Executing: %s', cmd)
+            system(cmd, real_env)
+            if dispatch_cmd is not None:
+                system(dispatch_cmd)
+                dispatch_cmd = None
+            t1 = t0 + datetime.timedelta(seconds=(time.time() - ts) *
+                                         (rate or 1))
+            done = (wf, t0, t1)
+        stop_modules(mods, sandbox)
+        if done is not None:
+            attribute(done, windows, database, known)
     except KeyboardInterrupt:
-        if eventfile is not None:
+        if dispatch_cmd is not None:
             system(dispatch_cmd)
-        system(['seiscomp', 'stop'])
+        stop_modules(mods, sandbox)
     except Exception, e:
         tb = traceback.format_exc()
         sys.stderr.write("Exception: %s" % tb)
         sys.stderr.write("Exception: %s\n" % str(e))
-        system(['seiscomp', 'stop'])
+        stop_modules(mods, sandbox)
+        # let the caller, e.g. run_parallel() through the exit code, know
+        # that the playback failed
+        raise
+    finally:
+        os.unlink(scmaster_cfg)
+        if clock is not None:
+            os.unlink(clock)
+        if faketime is not None:
+            faketime.stdin.close()
+            faketime.wait()
+
+
+def attribute(playback, windows, database, known):
+    """
+    Append the (waveforms, start, end) of *playback* and the events that
+    appeared in *database* since the IDs in *known* were read to the file
+    *windows*. Returns the IDs of all events now in the database.
+    """
+    events = database_events(database)
+    if windows is not None:
+        wf, t0, t1 = playback
+        f = open(windows, 'a')
+        try:
+            f.write('%s\t%s\t%s\t%s\n' % (
+                wf, t0.strftime('%Y-%m-%d %H:%M:%S'),
+                t1.strftime('%Y-%m-%d %H:%M:%S'),
+                ','.join(sorted(events - known))))
+        finally:
+            f.close()
+    return events
+
+
+def run_parallel(playbacks, database, config_dir, sandbox_dir, jobs=2,
+                 base_port=20000, options=[]):
+    """
+    Run every (waveforms, eventfile) pair of *playbacks* in its own sandbox
+    below *sandbox_dir*, *jobs* of them at the same time. Each playback is
+    a separate playback.py process that gets *options* as additional
+    command line arguments. Returns the waveforms of failed playbacks.
+    """
+    tasks = Queue.Queue()
+    for n, (wf, eventfile) in enumerate(playbacks):
+        tasks.put((n, wf, eventfile))
+    failed = []
+    lock = threading.Lock()
+
+    def worker(slot):
+        # every worker has its own ports, so the sandboxes that run at the
+        # same time never share them
+        port = base_port + 10 * slot
+        while True:
+            try:
+                n, wf, eventfile = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            name = '%03d-%s' % (n, os.path.basename(wf.rstrip('/')))
+            path = os.path.abspath(os.path.join(sandbox_dir, name))
+            try:
+                db, fifo, environ = setup_sandbox(path, config_dir, database,
+                                                  port)
+            except (IOError, OSError, shutil.Error), e:
+                error('%s: cannot create sandbox: %s' % (name, e))
+                with lock:
+                    failed.append(wf)
+                continue
+            cmd = [sys.executable, os.path.realpath(__file__), db,
+                   os.path.abspath(wf), '--sandbox', '--port', str(port),
+                   '-f', fifo, '-c', os.path.join(path, 'home', '.seiscomp3')]
+            if eventfile is not None:
+                cmd += ['-e', os.path.abspath(eventfile)]
+            cmd += options
+            print "%s: started in %s" % (name, path)
+            log = open(os.path.join(path, 'playback.log'), 'w')
+            try:
+                rc = sp.call(cmd, env=environ, stdout=log, stderr=sp.STDOUT)
+            finally:
+                log.close()
+            print "%s: finished with exit code %d" % (name, rc)
+            if rc:
+                with lock:
+                    failed.append(wf)
+
+    threads = [threading.Thread(target=worker, args=(slot,))
+               for slot in xrange(min(jobs, len(playbacks)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    while any(t.is_alive() for t in threads):
+        # join() with a timeout keeps the main thread responsive to Ctrl-C
+        for t in threads:
+            t.join(0.5)
+    return failed
 
 
 if __name__ == '__main__':
@@ -371,11 +921,34 @@ if __name__ == '__main__':
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('database', help='Absolute path to an sqlite3 \
     database filename containing inventory and station bindings.')
-    parser.add_argument('waveforms' , help="Absolute path to a \
-    multiplexed MiniSEED file containing the waveform data.")
+    parser.add_argument('waveforms' , nargs='?', help="Absolute path to a \
+    multiplexed MiniSEED file containing the waveform data or to a directory \
+    of MiniSEED files that will be merged on the fly.")
     parser.add_argument('-e', '--events', help='Absolute path to an SeisComP3ML \
     file containing event information that will be merged with the playback \
     results.', default=None)
+    parser.add_argument('-b', '--batch', help="""File listing several
+    playbacks that are run one after another without restarting the modules.
+    Every line holds a waveform file or directory and, separated by a tab,
+    optionally an event file. The waveforms argument is ignored.""",
+                        default=None)
+    parser.add_argument('-w', '--windows', help="""File to which a line
+    is appended for every playback with the waveforms, the start and end
+    time and the comma separated IDs of the events created during the
+    playback, separated by tabs.""", default=None)
+    parser.add_argument('-p', '--parallel', help="""Run the playbacks in
+    this many sandboxes at the same time. Every sandbox has its own
+    configuration directory, ports, fifo, logs, database and clock.""",
+                        type=int, default=None)
+    parser.add_argument('--sandbox-dir', help="""Directory in which the
+    sandboxes of --parallel are created. The results of a playback are in
+    the database copy of its sandbox.""", default='sandboxes')
+    parser.add_argument('--base-port', help="""Messaging port of the first
+    sandbox; every sandbox uses ten ports.""", type=int, default=20000)
+    parser.add_argument('--sandbox', help="""Run inside a sandbox created by
+    --parallel; only used internally.""", action='store_true')
+    parser.add_argument('--port', help="""Messaging port of the sandbox;
+    only used internally.""", type=int, default=SPREAD_PORT)
     parser.add_argument('-c', '--config-dir', help='Directory containing \
     configuration files.',
                         default=ei.configDir())
@@ -388,9 +961,14 @@ if __name__ == '__main__':
     (XX: network code, ABC: station code, d: delay in seconds as a decimal
     number). The special entry 'default: d' defines the delay for all stations
     not listed explicitely.""", default=None)
-    parser.add_argument('-s', '--speed', help='Speed factor.', default=None)
+    parser.add_argument('-s', '--speed', help="""Speed factor. In historic
+    mode the simulated clock of the modules runs at the same speed.""",
+                        default=None)
     parser.add_argument('-j', '--jump', help='Number of minutes to skip.',
                         default=None)
+    parser.add_argument('--startup-timeout', help="""Maximum number of
+    seconds to wait for all modules to connect before the playback starts.""",
+                        type=int, default=60)
     parser.add_argument('-m', '--mode', help="""Choose between 'realtime' and
     'historic'. For 'realtime' the records in the input file will get a new
     timestamp relative to the current system time at startup. For 'historic'
@@ -399,9 +977,41 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
     try:
-        run(args.waveforms, args.database, args.config_dir, args.fifo,
-            speed=args.speed, jump=args.jump, delays=args.delays,
-            mode=args.mode, eventfile=args.events)
+        if args.parallel is not None:
+            if args.batch is not None:
+                playbacks = read_batch(args.batch)
+            elif args.waveforms is not None:
+                playbacks = [(args.waveforms, args.events)]
+            else:
+                parser.error('waveforms or --batch are required')
+            options = ['-m', args.mode,
+                       '--startup-timeout', str(args.startup_timeout)]
+            for flag, value in (('-s', args.speed), ('-j', args.jump),
+                                ('-d', args.delays)):
+                if value is not None:
+                    options += [flag, value]
+            failed = run_parallel(playbacks, args.database, args.config_dir,
+                                  args.sandbox_dir, args.parallel,
+                                  args.base_port, options)
+            if failed:
+                error('%d of %d playbacks failed' % (len(failed),
+                                                     len(playbacks)))
+                sys.exit(1)
+        elif args.batch is not None:
+            run_batch(read_batch(args.batch), args.database, args.config_dir,
+                      args.fifo, speed=args.speed, jump=args.jump,
+                      delays=args.delays, mode=args.mode,
+                      startupdelay=args.startup_timeout, windows=args.windows)
+        elif args.waveforms is None:
+            parser.error('waveforms or --batch are required')
+        else:
+            run(args.waveforms, args.database, args.config_dir, args.fifo,
+                speed=args.speed, jump=args.jump, delays=args.delays,
+                mode=args.mode, startupdelay=args.startup_timeout,
+                eventfile=args.events, sandbox=args.sandbox, port=args.port)
     except PBError, e:
         print e
-        sys.exit()
+        sys.exit(1)
+    except Exception:
+        # already reported by run_batch()
+        sys.exit(1)
@@ -25,32 +25,17 @@ FILEIN=""
 ACTION=""
 MODE="historic"
 DELAYS=""
+SPEED=""
 MSVIEW=$HOME"/libmseed-2.18/example/msview"
 
 function get_start_time(){
-	python -c 'import seiscomp3.IO,seiscomp3.Kernel,datetime
-from seiscomp3 import Config, System
-
-stream = seiscomp3.IO.RecordStream.Open("file://'$1'")
-input = seiscomp3.IO.RecordInput(stream, seiscomp3.Core.Array.INT,
-			     seiscomp3.Core.Record.SAVE_RAW)
-tmin = datetime.datetime.utcnow()
-while True:
-	try:
-		rec = input.next()
-	except:
-		break
-	if not rec:
-		break
-	te = rec.endTime().toString("%FT%T.%4fZ")
-	ts = rec.startTime().toString("%FT%T.%4fZ")
-	dts = datetime.datetime.strptime(ts, "%Y-%m-%dT%H:%M:%S.%fZ")
-	dte = datetime.datetime.strptime(te, "%Y-%m-%dT%H:%M:%S.%fZ")
-	if dte < tmin:
-		tmin = dte
-		Id = rec.streamID()
-print(tmin)
-'
+	python "${PLAYBACKROOT}/msrecord.py" "$1"
+}
+
+function run_batch(){
+	# play back the events in batch.txt with the scanloc license $1
+	[ -n "$1" ] && cp -v "$1" ~/.seiscomp3/licenses/scanloc.crt
+	"$RUNPLAYBACK" tmp.sqlite "${DELAYS}" -c "${CONFIGDIR}" -m ${MODE} ${SPEED:+-s ${SPEED}} --batch batch.txt --windows "${PBDIR}/playback-windows.txt"
 }
 
 function loadsconf(){
@@ -119,6 +104,9 @@ Options:
                     CH.AIGLE: 5.2
                     CH.VANNI: 3.5
                     ...
+    --speed         Play back the records this many times faster than real
+                    time. In 'historic' mode the simulated clock of the
+                    modules runs at the same speed. (Default: 1)
   fixclient
     --scautopick    Alias name of scautopick to be bound (Default: 'scautopick').
     --profile       Name of the scautopick profile fto be bound (Default: 'Local').
@@ -318,42 +306,27 @@ function setupdata(){
 	# if no event requested, then one miniseed file for whole time span 
 	if [ -z "$EVENTID" ] && [ -z "$FILEIN" ] 
 	then
-		mkdir sds
-		mkdir datasets
-        	for R in ${RECORDURL}
-		do 
-			"$MAKEMSEEDPLAYBACK"  -u playback -H ${HOST} ${DBCONN} --debug --start ${BEGIN/ /T} --end ${END/ /T}  -I "${R}" &> make-mseed-playback.logerr
-			${SEISCOMP_ROOT}/bin/scart -I  ${BEGIN/ /T}-sorted-mseed  sds/
-			mv ${BEGIN/ /T}-sorted-mseed datasets/${BEGIN/ /T}-${R//[:\/]*}-sorted-mseed
-		done
-		${SEISCOMP_ROOT}/bin/scart -c "*" -dsE -t "${BEGIN}~${END}" sds/ > ${BEGIN/ /T}-sorted-mseed
-		rm -r sds
+		# all record sources are merged, the first one has the highest priority
+		"$MAKEMSEEDPLAYBACK"  -u playback -H ${HOST} ${DBCONN} --debug --start ${BEGIN/ /T} --end ${END/ /T}  --sources "${RECORDURL}" ${WAVEFORMCACHE:+--cache "${WAVEFORMCACHE}"} &> make-mseed-playback.logerr
 		echo "Examine data with:"
 		echo ${PBDIR}/make-mseed-playback.logerr
 		echo "scrttv --debug --offline --record-file ${PBDIR}/${BEGIN/ /T}.sorted-mseed"
 	
-	# otherwise process requested events individually 
+	# otherwise dump all requested events in one go
 	else 
+		printf "%s\n" "${evids[@]}" > events.txt
+		# all record sources are merged, the first one has the highest priority
+		if [ -z "${DBCONNIC}" ]; then
+			"$MAKEMSEEDPLAYBACK"  -u playback -H ${HOST} ${DBCONN} --events events.txt -R ${RADIUS} --sources "${RECORDURL}" ${WAVEFORMCACHE:+--cache "${WAVEFORMCACHE}"} &> make-mseed-playback.logerr
+		else
+			"$MAKEMSEEDPLAYBACK"  -u playback -H ${HOST} ${DBCONNIC} --events events.txt -R ${RADIUS} --sources "${RECORDURL}" ${WAVEFORMCACHE:+--cache "${WAVEFORMCACHE}"} &> make-mseed-playback.logerr
+		fi
+		# every event is written to <event>-M<magnitude>.sorted-mseed in PBDIR
 		for TMPID in ${evids[@]}
 		do
-			mkdir sds
-			mkdir datasets
-			for R in ${RECORDURL}
-			do
-				echo $R
-				if [ -z "${DBCONNIC}" ]; then
-					"$MAKEMSEEDPLAYBACK"  -u playback -H ${HOST} ${DBCONN} -E ${TMPID} -R ${RADIUS} -I "${R}" &> make-mseed-playback.logerr
-				else
-					"$MAKEMSEEDPLAYBACK"  -u playback -H ${HOST} ${DBCONNIC} -E ${TMPID} -R ${RADIUS} -I "${R}" &> make-mseed-playback.logerr
-				fi
-				${SEISCOMP_ROOT}/bin/scart -I  ${TMPID}-sorted-mseed  sds/
-				mv ${TMPID}-sorted-mseed datasets/${TMPID}-${R//[:\/]*}-sorted-mseed
-			done
-			${SEISCOMP_ROOT}/bin/scart -c "*" -dsE -t "1970-01-01 00:00~2999-01-01 00:00" sds/ > ${TMPID}-sorted-mseed
-			rm -r sds
 			echo "Examine data with:"
 			echo ${PBDIR}/make-mseed-playback.logerr
-			echo "scrttv --debug --offline --record-file \"${PBDIR}/${TMPID}\"*.sorted-mseed"
+			echo "scrttv --debug --offline --record-file \"${PBDIR}/${TMPID//\//_}\"*.sorted-mseed"
 		done
 	fi
 	cd -
@@ -381,6 +354,7 @@ do
                 --inventory-format) INVENTORYFORMAT="$2";shift;;
 		--mode) MODE="$2"; shift;;
 		--delaytbl) DELAYTBL="$2";shift;;
+		--speed) SPEED="$2";shift;;
 		--scautopick) SCAUTOPICK="$2";shift;;
 		--profile) PICKPROFILE="$2";shift;;
 		-h) usage; exit 0;;
@@ -606,8 +580,11 @@ then
 		MSFILE=`ls "${PBDIR}"/*sorted-mseed|head -1`
         	EVNTFILE=`ls "${PBDIR}"/*_events.xml`
 
-		"$RUNPLAYBACK"  tmp.sqlite "${MSFILE}" "${DELAYS}" -c "${CONFIGDIR}" -m ${MODE} -e "${EVNTFILE}"
+		"$RUNPLAYBACK"  tmp.sqlite "${MSFILE}" "${DELAYS}" -c "${CONFIGDIR}" -m ${MODE} ${SPEED:+-s ${SPEED}} -e "${EVNTFILE}"
 	else 
+		# the events are played back in time order by one run of the modules
+		# per scanloc license
+		: > events.txt
 		for TMPID in ${evids[@]}
 		do
 			# event data
@@ -615,11 +592,24 @@ then
 			MSFILE=`ls "${PBDIR}/"*${EVTNAME}*.sorted-mseed|head -1`
 			EVNTFILE=`ls "${PBDIR}/"*${EVTNAME}*.xml`
 			STARTTIME=`get_start_time ${MSFILE}`
-			STARTTIME=${STARTTIME//-/}
-			STARTTIME=${STARTTIME:0:8}
-			ls ~/.seiscomp3/licenses/scanloc_????????_????????.crt |awk -F'_' '($2*1<='${STARTTIME}') {print "cp -v",$0,"~/.seiscomp3/licenses/scanloc.crt"}'|tail -1|$SHELL
-			"$RUNPLAYBACK" tmp.sqlite  "${MSFILE}" "${DELAYS}" -c "${CONFIGDIR}" -m ${MODE} -e "${EVNTFILE}"
+			STARTDAY=${STARTTIME//-/}
+			STARTDAY=${STARTDAY:0:8}
+			LICENSE=`ls ~/.seiscomp3/licenses/scanloc_????????_????????.crt 2>/dev/null |awk -F'_' '($2*1<='${STARTDAY}') {print $0}'|tail -1`
+			printf "%s\t%s\t%s\t%s\n" "${STARTTIME}" "${LICENSE}" "${MSFILE}" "${EVNTFILE}" >> events.txt
 		done
+		rm -f "${PBDIR}/playback-windows.txt"
+		: > batch.txt
+		BATCHLICENSE=""
+		while IFS=$'\t' read STARTTIME LICENSE MSFILE EVNTFILE
+		do
+			if [ -s batch.txt ] && [ "$LICENSE" != "$BATCHLICENSE" ]; then
+				run_batch "$BATCHLICENSE"
+				: > batch.txt
+			fi
+			BATCHLICENSE=$LICENSE
+			printf "%s\t%s\n" "${MSFILE}" "${EVNTFILE}" >> batch.txt
+		done < <(sort events.txt)
+		run_batch "$BATCHLICENSE"
 	
 	fi
 	cp tmp.sqlite "${PBDIR}/${PBDB}"
@@ -631,6 +621,13 @@ then
 	do 
 		scxmldump --plugins dbsqlite3 -d "sqlite3://${PBDIR}/${PBDB}" -fPAMF -E $E -o ${PBDIR}/xmldump/${E//\//_}.xml &>> ${CONFIGDIR}/log/scxmldump.logerr
 	done
+	# list the events created during every playback of a batch
+	if [ -f "${PBDIR}/playback-windows.txt" ]; then
+		while IFS=$'\t' read MSF WBEGIN WEND WEVIDS
+		do
+			echo "${WEVIDS}" | tr ',' '\n' | grep -v '^$' > "${PBDIR}/xmldump/$(basename "${MSF%.sorted-mseed}").events"
+		done < "${PBDIR}/playback-windows.txt"
+	fi
 
 	# save the conf
 	rsync -avzl --delete \
@@ -0,0 +1,148 @@
+"""
+Checks of the MiniSEED re-blocking in msrecord.py on synthetic records.
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import random
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import msrecord
+from msrecord import INT32, STEIM1, STEIM2, FRAME_LEN, DATA_OFFSET
+
+
+def make_record(samples, encoding, reclen=4096, ticks=14900000000000,
+                cha='HHZ'):
+    """
+    Return a big endian record of *reclen* bytes with all *samples*.
+    """
+    out = bytearray(reclen)
+    year, doy, hour, minute, second, tms = msrecord.ticks_to_btime(ticks)
+    header = ['000001', 'D', ' ', 'TEST ', '  ', cha, 'XX', year, doy, hour,
+              minute, second, tms, len(samples), 100, 1, 0, 0, 0, 1, 0,
+              DATA_OFFSET, msrecord.FIXED_HEADER_LEN]
+    msrecord._fixed_header['>'].pack_into(out, 0, *header)
+    struct.pack_into('>HHBBBx', out, msrecord.FIXED_HEADER_LEN, 1000, 0,
+                     encoding, 1, reclen.bit_length() - 1)
+    if encoding == INT32:
+        payload = struct.pack('>%dl' % len(samples), *samples)
+    else:
+        diffs = [0] + [b - a for a, b in zip(samples, samples[1:])]
+        nframes = (reclen - DATA_OFFSET) // FRAME_LEN
+        payload, n = msrecord.encode_steim(samples, diffs, 0, nframes, '>',
+                                           encoding)
+        assert n == len(samples)
+    out[DATA_OFFSET:DATA_OFFSET + len(payload)] = payload
+    return msrecord.Record(out)
+
+
+def decode(rec):
+    """
+    Return the samples of the Steim or INT32 record *rec*.
+    """
+    b1000 = rec.blockette(1000)
+    encoding = struct.unpack_from('B', rec.data, b1000 + 4)[0]
+    pdata = rec.offset + DATA_OFFSET
+    if encoding == INT32:
+        return list(struct.unpack_from('>%dl' % rec.nsamp, rec.data, pdata))
+    return msrecord.decode_steim(rec.data, pdata,
+                                 (rec.size - DATA_OFFSET) // FRAME_LEN,
+                                 rec.nsamp, '>', encoding)
+
+
+def random_walk(n, step, seed=1):
+    rnd = random.Random(seed)
+    x = 0
+    samples = []
+    for i in xrange(n):
+        # mix small and large differences to use every packing, and stay
+        # within 32 bit samples
+        x += rnd.randint(-step, step) >> rnd.randint(0, 24)
+        x = max(-(1 << 30), min(x, (1 << 30) - 1))
+        samples.append(x)
+    return samples
+
+
+class SteimTest(unittest.TestCase):
+
+    def round_trip(self, encoding, step):
+        samples = random_walk(2000, step)
+        diffs = [0] + [b - a for a, b in zip(samples, samples[1:])]
+        start = 0
+        while start < len(samples):
+            payload, n = msrecord.encode_steim(samples, diffs, start, 7, '>',
+                                               encoding)
+            self.assertTrue(n > 0)
+            decoded = msrecord.decode_steim(payload, 0,
+                                            len(payload) // FRAME_LEN, n,
+                                            '>', encoding)
+            self.assertEqual(decoded, samples[start:start + n])
+            start += n
+
+    def test_steim1(self):
+        self.round_trip(STEIM1, 1 << 31)
+
+    def test_steim2(self):
+        self.round_trip(STEIM2, 1 << 29)
+
+    def test_too_large_difference(self):
+        samples = [0, 1 << 30]
+        self.assertRaises(msrecord.MSeedError, msrecord.encode_steim,
+                          samples, [0, 1 << 30], 0, 7, '>', STEIM2)
+
+
+class ReblockTest(unittest.TestCase):
+
+    def check_split(self, rec, samples):
+        pieces = msrecord.reblock(rec)
+        self.assertTrue(all(p.size == 512 for p in pieces))
+        self.assertEqual(sum(p.nsamp for p in pieces), len(samples))
+        decoded = []
+        for p in pieces:
+            decoded.extend(decode(p))
+        self.assertEqual(decoded, samples)
+        self.assertAlmostEqual(pieces[0].begin, rec.begin, 5)
+        self.assertAlmostEqual(pieces[-1].end, rec.end, 5)
+        for a, b in zip(pieces, pieces[1:]):
+            self.assertAlmostEqual(a.end, b.begin, 5)
+        return pieces
+
+    def test_steim2(self):
+        samples = random_walk(3000, 1 << 12)
+        self.assertTrue(len(self.check_split(make_record(samples, STEIM2),
+                                             samples)) > 1)
+
+    def test_steim1(self):
+        samples = random_walk(1500, 1 << 12)
+        self.check_split(make_record(samples, STEIM1), samples)
+
+    def test_int32(self):
+        samples = random_walk(500, 1 << 20)
+        self.check_split(make_record(samples, INT32), samples)
+
+    def test_single_piece(self):
+        # a record that fits into one 512 byte record is still re-blocked
+        samples = random_walk(100, 1 << 20)
+        rec = make_record(samples, INT32)
+        out = list(msrecord.reblock_records([rec]))
+        self.assertEqual([r.size for r in out], [512])
+        self.assertEqual(decode(out[0]), samples)
+
+    def test_order(self):
+        # the pieces of a long record are sent before later short records
+        long_rec = make_record(random_walk(3000, 1 << 12), STEIM2)
+        short = make_record(random_walk(50, 1 << 12), STEIM2, reclen=512,
+                            ticks=14900000000000 + 290000, cha='HHN')
+        out = list(msrecord.reblock_records([long_rec, short]))
+        ends = [r.end for r in out]
+        self.assertEqual(ends, sorted(ends))
+        self.assertEqual(len(out), len(msrecord.reblock(long_rec)) + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()